@@ -0,0 +1,82 @@
+import struct
+from socket import inet_ntoa
+
+
+def format_addresses(first, count):
+    # dotted-quad strings for count consecutive addresses starting at the
+    # integer address first; packed in one batch instead of one IPv4Address each
+    if count <= 0:
+        return []
+    packed = struct.pack('!{0}I'.format(count), *range(first, first + count))
+    return [inet_ntoa(packed[i:i + 4]) for i in range(0, count * 4, 4)]
+
+
+def check_block(network, highest_offset, name):
+    if highest_offset >= network.num_addresses:
+        raise ValueError("{0} subnet {1} is too small for this fabric (needs {2} addresses)".format(
+                         name, network, highest_offset + 1))
+
+
+class AddressRange(object):
+    # Indexable view of count consecutive addresses starting at the integer
+    # address first; each address is only formatted when it is looked up.
+    def __init__(self, first, count):
+        self.first = first
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError('address index out of range')
+        return inet_ntoa(struct.pack('!I', self.first + index))
+
+    def __iter__(self):
+        return iter(format_addresses(self.first, self.count))
+
+
+def build_address_plan(user_input, layout, lazy=False):
+    # Every address of a fabric computed with plain integer offsets from the
+    # start of the mgmt/loopback/ptp blocks and formatted exactly once; the
+    # leaf, border leaf and spine builders all read from this plan. A lazy
+    # plan holds AddressRange views instead, for rendering single devices.
+    if lazy:
+        addresses = AddressRange
+    else:
+        addresses = format_addresses
+    num_leafs = layout['num_leafs']
+    num_bleafs = layout['num_bleafs']
+    num_spines = layout['num_spines']
+    # spine ports in use: leafs, then border leafs from bleaf_port_start + 1
+    num_ports = layout['bleaf_port_start'] + num_bleafs
+    mgmt_network = user_input['mgmt_subnet']
+    loopback_network = user_input['loopback_subnet']
+    ptp_network = user_input['ptp_subnet']
+
+    check_block(mgmt_network, layout['leaf_mgmt_start'] + num_leafs, 'Mgmt')
+    check_block(loopback_network, layout['vlan2_start'] + num_leafs + 1, 'Loopback')
+    check_block(ptp_network, layout['ptp_block'] * num_spines - 1, 'PTP')
+
+    mgmt = int(mgmt_network.network_address)
+    loopback = int(loopback_network.network_address)
+    ptp = int(ptp_network.network_address)
+
+    return {'mgmt_default_gateway': format_addresses(mgmt + 1, 1)[0],
+            'pim_anycast_rp': format_addresses(int(loopback_network.broadcast_address), 1)[0],
+            'leaf_mgmt': addresses(mgmt + layout['leaf_mgmt_start'] + 1, num_leafs),
+            'bleaf_mgmt': addresses(mgmt + layout['bleaf_mgmt_start'] + 1, num_bleafs),
+            'spine_mgmt': addresses(mgmt + layout['spine_mgmt_start'] + 1, num_spines),
+            'leaf_loopback0': addresses(loopback + 1, num_leafs),
+            'bleaf_loopback0': addresses(loopback + layout['bleaf_lo0_start'] + 1, num_bleafs),
+            'spine_loopback0': format_addresses(loopback + layout['spine_lo0_start'] + 1, num_spines),
+            'leaf_loopback1': addresses(loopback + layout['lo1_start'] + 1, num_leafs),
+            'bleaf_loopback1': addresses(loopback + layout['bleaf_lo1_start'] + 1, num_bleafs),
+            'pair_vtep': addresses(loopback + layout['vtep_start'] + 1, layout['num_leaf_pairs']),
+            'leaf_vlan2': addresses(loopback + layout['vlan2_start'] + 1, num_leafs),
+            # one /31 per spine port: port k (0-based, leafs then border leafs)
+            # uses [2k] on the spine side and [2k + 1] on the leaf side
+            'ptp': [addresses(ptp + layout['ptp_block'] * spine, num_ports * 2)
+                    for spine in range(0, num_spines)]}
@@ -0,0 +1,200 @@
+import csv
+import json
+import os
+import concurrent.futures
+
+import config_generator
+import conflicts
+import metrics
+from output import ArchiveWriter
+
+
+def load_fabric_specs(path):
+    # A spec file is a list of fabric definitions using the same field names
+    # as get_user_input: JSON/YAML (a list, or a mapping with a 'fabrics' list)
+    # or CSV with one fabric per row and the field names as the header.
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, newline='') as spec_file:
+        if extension == '.csv':
+            return list(csv.DictReader(spec_file))
+        if extension in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("PyYAML is required to read YAML spec files (pip install pyyaml)")
+            specs = yaml.safe_load(spec_file)
+        elif extension == '.json':
+            specs = json.load(spec_file)
+        else:
+            raise ValueError("Unsupported spec file type '{0}' - use .json, .yaml, .yml or .csv".format(extension))
+    if isinstance(specs, dict):
+        specs = specs.get('fabrics')
+    if not isinstance(specs, list):
+        raise ValueError("Spec file must contain a list of fabrics")
+    return specs
+
+
+def validate_fabric_specs(specs):
+    # returns (user_inputs, failures); a failure is reported per spec entry
+    user_inputs = []
+    failures = []
+    for index, spec in enumerate(specs):
+        name = '#{0}'.format(index + 1)
+        if isinstance(spec, dict) and spec.get('name_prefix'):
+            name = str(spec['name_prefix'])
+        try:
+            if not isinstance(spec, dict):
+                raise ValueError("Fabric definition must be a mapping of field names to values")
+            user_inputs.append(config_generator.validate_user_input(spec))
+        except ValueError as e:
+            failures.append({'name_prefix': name, 'ok': False, 'devices': 0, 'error': str(e)})
+    return user_inputs, failures
+
+
+def check_conflicts(user_inputs, output_root=None):
+    # (user_inputs, failures): fabrics whose subnets or identifiers collide
+    # with another fabric of the batch or of output_root are not generated
+    errors = {}
+    names = set(user_input['name_prefix'] for user_input in user_inputs)
+    for conflict in conflicts.check_fabrics(user_inputs, output_root):
+        for name in conflict['fabrics']:
+            if name in names and conflict['error'] not in errors.setdefault(name, []):
+                errors[name].append(conflict['error'])
+    failures = [{'name_prefix': name, 'ok': False, 'devices': 0, 'error': '; '.join(errors[name])}
+                for name in sorted(errors)]
+    return [user_input for user_input in user_inputs if user_input['name_prefix'] not in errors], failures
+
+
+def generate_fabric(user_input, output_root, incremental=False, profile=False, cprofile=None):
+    # with profile=True the worker's metrics report is returned in the result,
+    # with cprofile its cProfile statistics are dumped to that path
+    if profile:
+        metrics.enable()
+    try:
+        with metrics.cprofiled(cprofile):
+            report = config_generator.generate_device_configs(user_input, output_root, verbose=False,
+                                                              incremental=incremental)
+    except Exception as e:
+        result = {'name_prefix': user_input['name_prefix'], 'ok': False, 'devices': 0,
+                  'error': '{0}: {1}'.format(type(e).__name__, e)}
+    else:
+        result = {'name_prefix': user_input['name_prefix'], 'ok': True,
+                  'devices': len(report['changed']) + len(report['unchanged']), 'error': None,
+                  'incremental': incremental, 'report': report}
+    if profile:
+        result['metrics'] = metrics.disable().report()
+    return result
+
+
+def render_fabric(user_input, profile=False, cprofile=None):
+    # returns (result, [(filename, config)]) for writing into an archive
+    if profile:
+        metrics.enable()
+    try:
+        with metrics.cprofiled(cprofile):
+            configs = config_generator.render_device_configs(user_input)
+    except Exception as e:
+        result = {'name_prefix': user_input['name_prefix'], 'ok': False, 'devices': 0,
+                  'error': '{0}: {1}'.format(type(e).__name__, e)}
+        configs = []
+    else:
+        result = {'name_prefix': user_input['name_prefix'], 'ok': True, 'devices': len(configs), 'error': None}
+    if profile:
+        result['metrics'] = metrics.disable().report()
+    return result, configs
+
+
+def collect_metrics(result):
+    # fold a worker's metrics into this process's report
+    report = result.pop('metrics', None)
+    if report is not None and metrics.active is not None:
+        metrics.active.merge(report)
+    return result
+
+
+def generate_fabrics(user_inputs, output_root, workers=None, incremental=False):
+    # Fan the fabrics out across a process pool; results keep the input order.
+    if not user_inputs:
+        return []
+    profile = metrics.active is not None
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(generate_fabric, user_input, output_root, incremental, profile,
+                                   metrics.cprofile_dump(user_input['name_prefix']))
+                   for user_input in user_inputs]
+        return [collect_metrics(future.result()) for future in futures]
+
+
+def archive_fabrics(user_inputs, archive_path, workers=None):
+    # Fabrics are rendered across the process pool and written by this process
+    # into one archive, in input order, as each fabric's configs come back.
+    results = []
+    with ArchiveWriter(archive_path) as archive:
+        if not user_inputs:
+            return results
+        profile = metrics.active is not None
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(render_fabric, user_input, profile,
+                                       metrics.cprofile_dump(user_input['name_prefix']))
+                       for user_input in user_inputs]
+            for future in futures:
+                result, configs = future.result()
+                for filename, config in configs:
+                    with metrics.timer('write', os.path.splitext(filename)[0]):
+                        archive.write(result['name_prefix'] + '/' + filename, [config])
+                results.append(collect_metrics(result))
+    return results
+
+
+def format_summary(results):
+    lines = []
+    for result in results:
+        if result['ok'] and result.get('incremental'):
+            report = result['report']
+            lines.append("OK      {0}: {1} changed, {2} unchanged, {3} removed".format(
+                         result['name_prefix'], len(report['changed']), len(report['unchanged']),
+                         len(report['removed'])))
+        elif result['ok']:
+            lines.append("OK      {0}: {1} device configs written".format(result['name_prefix'], result['devices']))
+        else:
+            lines.append("FAILED  {0}: {1}".format(result['name_prefix'], result['error']))
+    succeeded = len([result for result in results if result['ok']])
+    lines.append("{0} of {1} fabrics generated successfully".format(succeeded, len(results)))
+    return '\n'.join(lines)
+
+
+def run_batch(spec_path, output_root, workers=None, incremental=False, archive_path=None):
+    user_inputs, failures = validate_fabric_specs(load_fabric_specs(spec_path))
+    if archive_path:
+        user_inputs, conflict_failures = check_conflicts(user_inputs)
+        return failures + conflict_failures + archive_fabrics(user_inputs, archive_path, workers)
+    user_inputs, conflict_failures = check_conflicts(user_inputs, output_root)
+    failures += conflict_failures
+    return failures + generate_fabrics(user_inputs, output_root, workers, incremental)
+
+
+def main(spec_path, output_root, workers=None, incremental=False, archive_path=None):
+    try:
+        results = run_batch(spec_path, output_root, workers, incremental, archive_path)
+    except (OSError, ValueError) as e:
+        print("Unable to read spec file {0}: {1}".format(spec_path, e))
+        return 2
+    print(format_summary(results))
+    if all(result['ok'] for result in results):
+        return 0
+    return 1
+
+
+def check(spec_path, output_root):
+    # --check: report invalid fabrics and conflicts without generating anything
+    try:
+        user_inputs, failures = validate_fabric_specs(load_fabric_specs(spec_path))
+    except (OSError, ValueError) as e:
+        print("Unable to read spec file {0}: {1}".format(spec_path, e))
+        return 2
+    found = conflicts.check_fabrics(user_inputs, output_root)
+    for failure in failures:
+        print("FAILED    {0}: {1}".format(failure['name_prefix'], failure['error']))
+    print(conflicts.format_conflicts(found))
+    if failures or found:
+        return 1
+    return 0
@@ -0,0 +1,267 @@
+import argparse
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import config_generator
+from allocator import build_address_plan
+from output import write_atomic
+from render_engine import RenderEngine
+
+# Headless benchmarks of the generator phases; run with
+#   python benchmark.py [--spines 2,4] [--fabrics 1,10] [--save | --compare]
+DEFAULT_SPINES = (2, 4)
+DEFAULT_FABRICS = (1, 10)
+DEFAULT_REPEAT = 3
+# a phase regresses if it is this much slower (or uses this much more memory)
+# than the baseline and the difference is above the noise floor
+DEFAULT_THRESHOLD = 0.2
+MIN_TIME_DELTA = 0.002  # seconds
+MIN_MEMORY_DELTA = 64 * 1024  # bytes
+BASELINE_VERSION = 1
+baseline_file = os.path.join(config_generator.homedir, '.benchmark_baseline.json')
+
+PHASES = ('address_plan', 'build_leaf_vars', 'build_bleaf_vars', 'build_spine_vars',
+          'compile', 'render', 'write')
+
+
+def fabric_specs(num_spines, num_fabrics):
+    # num_fabrics full gen1 fabrics with num_spines spines each
+    user_inputs = []
+    for fabric in range(0, num_fabrics):
+        user_inputs.append(config_generator.validate_user_input({
+            'mgmt_subnet': '10.{0}.{1}.0'.format(100 + fabric // 256, fabric % 256),
+            'loopback_subnet': '10.{0}.{1}.0'.format(110 + fabric // 256, fabric % 256),
+            'ptp_subnet': '10.{0}.{1}.0'.format(120 + fabric // 256, fabric % 256),
+            'name_prefix': 'BM{0:03d}SF'.format(fabric),
+            'num_spines': num_spines,
+            'bgp_asn': 64512 + fabric,
+            'ospf_area': '0.0.0.1',
+            'multicast_group_range': '239.1.1.0'}))
+    return user_inputs
+
+
+def phase_address_plan(state):
+    state['plans'] = [build_address_plan(user_input, config_generator.fabric_layout(user_input))
+                      for user_input in state['user_inputs']]
+
+
+def phase_build_leaf_vars(state):
+    state['leaf_vars'] = [config_generator.build_leaf_vars(user_input, plan)
+                          for user_input, plan in zip(state['user_inputs'], state['plans'])]
+
+
+def phase_build_bleaf_vars(state):
+    state['bleaf_vars'] = [config_generator.build_bleaf_vars(user_input, leaf_vars, plan)
+                           for user_input, leaf_vars, plan
+                           in zip(state['user_inputs'], state['leaf_vars'], state['plans'])]
+
+
+def phase_build_spine_vars(state):
+    state['spine_vars'] = [config_generator.build_spine_vars(user_input, leaf_vars, bleaf_vars, plan)
+                           for user_input, leaf_vars, bleaf_vars, plan
+                           in zip(state['user_inputs'], state['leaf_vars'], state['bleaf_vars'],
+                                  state['plans'])]
+
+
+def phase_compile(state):
+    # a fresh engine without the bytecode cache, so templates are really compiled
+    engine = RenderEngine(config_generator.homedir, config_generator.TemplateFilenames,
+                          shared_vars=config_generator.SharedTemplateVars)
+    for name in config_generator.TemplateFilenames:
+        engine.get_fragments(name)
+    state['engine'] = engine
+
+
+def phase_render(state):
+    engine = state['engine']
+    configs = []
+    for leaf_vars, bleaf_vars, spine_vars, user_input in zip(state['leaf_vars'], state['bleaf_vars'],
+                                                             state['spine_vars'], state['user_inputs']):
+        devices = ([(config_generator.LeafTemplateFilename, vars) for vars in leaf_vars['leafs']] +
+                   [(config_generator.BLeafTemplateFilename, vars) for vars in bleaf_vars['bleafs']] +
+                   [(config_generator.SpineTemplateFilename, vars) for vars in spine_vars['spines']])
+        for template, vars in devices:
+            configs.append((os.path.join(user_input['name_prefix'], vars['hostname'] + '.txt'),
+                            engine.render(template, vars)))
+    state['configs'] = configs
+
+
+def phase_write(state):
+    for user_input in state['user_inputs']:
+        config_generator.create_fabric_directory(user_input['name_prefix'], state['output_dir'])
+    for filename, config in state['configs']:
+        write_atomic(os.path.join(state['output_dir'], filename), [config])
+
+
+PHASE_FUNCTIONS = {'address_plan': phase_address_plan,
+                   'build_leaf_vars': phase_build_leaf_vars,
+                   'build_bleaf_vars': phase_build_bleaf_vars,
+                   'build_spine_vars': phase_build_spine_vars,
+                   'compile': phase_compile,
+                   'render': phase_render,
+                   'write': phase_write}
+
+
+def run_phases(user_inputs, trace_memory=False):
+    # {phase: seconds} or, with trace_memory, {phase: peak bytes allocated}
+    # for one pass over all phases
+    results = {}
+    output_dir = tempfile.mkdtemp(prefix='benchmark-')
+    state = {'user_inputs': user_inputs, 'output_dir': output_dir}
+    try:
+        for phase in PHASES:
+            gc.collect()
+            if trace_memory:
+                tracemalloc.start()
+                start = tracemalloc.get_traced_memory()[0]
+                PHASE_FUNCTIONS[phase](state)
+                results[phase] = tracemalloc.get_traced_memory()[1] - start
+                tracemalloc.stop()
+            else:
+                start = time.perf_counter()
+                PHASE_FUNCTIONS[phase](state)
+                results[phase] = time.perf_counter() - start
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return results
+
+
+def case_name(num_spines, num_fabrics):
+    return 'spines={0},fabrics={1}'.format(num_spines, num_fabrics)
+
+
+def run_benchmarks(spine_counts, fabric_counts, repeat=DEFAULT_REPEAT):
+    # {case: {phase: {'seconds': best of repeat runs, 'peak_bytes': ...}}};
+    # memory is traced in a separate pass since tracing slows everything down
+    results = {}
+    for num_spines in spine_counts:
+        for num_fabrics in fabric_counts:
+            user_inputs = fabric_specs(num_spines, num_fabrics)
+            timings = [run_phases(user_inputs) for run in range(0, repeat)]
+            memory = run_phases(user_inputs, trace_memory=True)
+            results[case_name(num_spines, num_fabrics)] = dict(
+                (phase, {'seconds': min(timing[phase] for timing in timings),
+                         'peak_bytes': memory[phase]}) for phase in PHASES)
+    return results
+
+
+def format_results(results):
+    lines = ["{0:<22} {1:<17} {2:>10} {3:>12}".format('case', 'phase', 'time (ms)', 'peak (KiB)')]
+    for case in results:
+        for phase in PHASES:
+            lines.append("{0:<22} {1:<17} {2:>10.2f} {3:>12.1f}".format(
+                         case, phase, results[case][phase]['seconds'] * 1000,
+                         results[case][phase]['peak_bytes'] / 1024.0))
+    return '\n'.join(lines)
+
+
+def load_baseline(path):
+    with open(path) as baseline:
+        baseline = json.load(baseline)
+    if not isinstance(baseline, dict) or baseline.get('version') != BASELINE_VERSION:
+        raise ValueError("{0} is not a version {1} benchmark baseline".format(path, BASELINE_VERSION))
+    return baseline['results']
+
+
+def save_baseline(path, results):
+    write_atomic(path, [json.dumps({'version': BASELINE_VERSION, 'results': results},
+                                   indent=1, sort_keys=True)])
+
+
+def compare_results(baseline, results, threshold=DEFAULT_THRESHOLD):
+    # [(case, phase, metric, baseline value, new value)] for every regression;
+    # cases or phases missing from the baseline are not compared
+    regressions = []
+    for case in results:
+        for phase in PHASES:
+            old = baseline.get(case, {}).get(phase)
+            if old is None:
+                continue
+            new = results[case][phase]
+            for metric, min_delta in (('seconds', MIN_TIME_DELTA), ('peak_bytes', MIN_MEMORY_DELTA)):
+                if new[metric] > old[metric] * (1 + threshold) and new[metric] - old[metric] > min_delta:
+                    regressions.append((case, phase, metric, old[metric], new[metric]))
+    return regressions
+
+
+def format_regressions(regressions):
+    lines = []
+    for case, phase, metric, old, new in regressions:
+        lines.append("REGRESSION  {0} {1} {2}: {3:.6g} -> {4:.6g} ({5:+.0%})".format(
+                     case, phase, metric, old, new, (new - old) / old))
+    lines.append("{0} regressions".format(len(regressions)))
+    return '\n'.join(lines)
+
+
+def parse_counts(value):
+    try:
+        counts = [int(count) for count in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected comma separated numbers, e.g. 1,10")
+    if not counts or min(counts) < 1:
+        raise argparse.ArgumentTypeError("counts must be at least 1")
+    return counts
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the fabric config generator phases.')
+    parser.add_argument('--spines', type=parse_counts, default=list(DEFAULT_SPINES), metavar='N,N',
+                        help='spine counts to benchmark (default: %(default)s)')
+    parser.add_argument('--fabrics', type=parse_counts, default=list(DEFAULT_FABRICS), metavar='N,N',
+                        help='numbers of fabrics per run (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, metavar='N',
+                        help='timed runs per case; the fastest is reported (default: %(default)s)')
+    parser.add_argument('--baseline', default=baseline_file, metavar='FILE',
+                        help='baseline file (default: %(default)s)')
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--compare', action='store_true',
+                        help='compare the results against the baseline and fail on regressions')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, metavar='FRACTION',
+                        help='allowed slowdown or memory growth (default: %(default)s)')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON instead of a table')
+    args = parser.parse_args(argv[1:])
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+    for count in args.spines:
+        try:
+            config_generator.validate_num_spines(count)
+        except ValueError as e:
+            parser.error(str(e))
+    return args
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.compare:
+        try:
+            baseline = load_baseline(args.baseline)
+        except (OSError, ValueError) as e:
+            print("Unable to read baseline {0}: {1}".format(args.baseline, e))
+            return 2
+    results = run_benchmarks(args.spines, args.fabrics, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=1, sort_keys=True))
+    else:
+        print(format_results(results))
+    status = 0
+    if args.compare:
+        regressions = compare_results(baseline, results, args.threshold)
+        print(format_regressions(regressions))
+        if regressions:
+            status = 1
+    if args.save:
+        save_baseline(args.baseline, results)
+        print("Baseline saved to {0}".format(args.baseline))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
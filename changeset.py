@@ -0,0 +1,198 @@
+import difflib
+import json
+import os
+import concurrent.futures
+
+import batch
+import config_generator
+import metrics
+
+# --diff: render every device in memory and compare it with the config
+# already under the output directory, without writing anything. Only a
+# config that differs is split into lines and gets a unified diff and the
+# line ranges that changed; an unchanged one costs a read and a compare.
+# Fabrics are split into tasks of up to DEVICES_PER_TASK devices that run
+# across a process pool, so a large fabric is spread over the workers too.
+DIFF_FORMATS = ('text', 'json')
+DEVICES_PER_TASK = 64
+CONTEXT_LINES = 3
+
+
+def unified_range(start, stop):
+    # (start, count) of lines [start, stop) as in a unified diff hunk header
+    if start == stop:
+        return [start, 0]
+    return [start + 1, stop - start]
+
+
+def format_range(line_range):
+    start, count = line_range
+    if count == 1:
+        return str(start)
+    return '{0},{1}'.format(start, count)
+
+
+def changed_ranges(old_lines, new_lines):
+    # [{'old': [start, count], 'new': [start, count]}] of every changed run of lines
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    return [{'old': unified_range(i1, i2), 'new': unified_range(j1, j2)}
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+
+
+def compare_config(path, config, name):
+    # the device's entry of the change set; name is the fabric relative path
+    # used in the diff headers
+    try:
+        # read with universal newlines like output.write_atomic writes, so
+        # configs written with CRLF line ends on Windows compare equal
+        with open(path, encoding='utf-8', errors='replace') as config_file:
+            old_config = config_file.read()
+    except FileNotFoundError:
+        return {'status': 'added', 'lines': config.count('\n')}
+    # strings compare their lengths before their contents
+    if old_config == config:
+        return {'status': 'unchanged'}
+    old_lines = old_config.splitlines(True)
+    new_lines = config.splitlines(True)
+    return {'status': 'changed',
+            'changes': changed_ranges(old_lines, new_lines),
+            'diff': ''.join(difflib.unified_diff(old_lines, new_lines, 'a/' + name, 'b/' + name,
+                                                 n=CONTEXT_LINES))}
+
+
+def diff_devices(user_input, output_root, start=0, stop=None, profile=False, cprofile=None):
+    # compares devices [start, stop) of a fabric, in output order; runs in a
+    # worker process and returns the fabric's result with one entry per device
+    if profile:
+        metrics.enable()
+    result = {'name_prefix': user_input['name_prefix'], 'ok': True, 'error': None, 'devices': []}
+    try:
+        with metrics.cprofiled(cprofile):
+            engine = config_generator.get_render_engine()
+            with metrics.timer('address_plan'):
+                fabric = config_generator.Fabric(user_input)
+            fabric_dir = os.path.join(output_root, user_input['name_prefix'])
+            for hostname in fabric.hostnames()[start:stop]:
+                template, vars = fabric.lookup(hostname)
+                with metrics.timer('render', hostname, template):
+                    config = engine.render(template, vars)
+                filename = hostname + '.txt'
+                device = {'hostname': hostname, 'filename': filename}
+                device.update(compare_config(os.path.join(fabric_dir, filename), config,
+                                             user_input['name_prefix'] + '/' + filename))
+                result['devices'].append(device)
+    except Exception as e:
+        result.update({'ok': False, 'error': '{0}: {1}'.format(type(e).__name__, e), 'devices': []})
+    if profile:
+        result['metrics'] = metrics.disable().report()
+    return result
+
+
+def fabric_tasks(user_input, devices_per_task=DEVICES_PER_TASK):
+    # (start, stop) device slices of a fabric, one per task
+    layout = config_generator.fabric_layout(user_input)
+    count = layout['num_leafs'] + layout['num_bleafs'] + layout['num_spines']
+    return [(start, min(start + devices_per_task, count)) for start in range(0, count, devices_per_task)]
+
+
+def removed_configs(fabric_dir, filenames):
+    # configs in fabric_dir of devices that are no longer part of the fabric
+    if not os.path.isdir(fabric_dir):
+        return []
+    return sorted(name for name in os.listdir(fabric_dir)
+                  if name.endswith('.txt') and name not in filenames)
+
+
+def change_set(results, output_root):
+    # one fabric's change set from the results of its tasks, in task order
+    change = {'name_prefix': results[0]['name_prefix'], 'ok': True, 'error': None,
+              'changed': [], 'added': [], 'removed': [], 'unchanged': 0}
+    failed = [result for result in results if not result['ok']]
+    if failed:
+        change.update({'ok': False, 'error': failed[0]['error']})
+        return change
+    filenames = set()
+    for result in results:
+        for device in result['devices']:
+            filenames.add(device['filename'])
+            status = device.pop('status')
+            if status == 'unchanged':
+                change['unchanged'] += 1
+            else:
+                change[status].append(device)
+    change['removed'] = removed_configs(os.path.join(output_root, change['name_prefix']), filenames)
+    return change
+
+
+def diff_fabrics(user_inputs, output_root, workers=None):
+    # [change set] of every fabric, in input order
+    tasks = [(user_input, start, stop) for user_input in user_inputs
+             for start, stop in fabric_tasks(user_input)]
+    profile = metrics.active is not None
+    if len(tasks) < 2 or workers == 1 or (workers is None and os.cpu_count() == 1):
+        # not worth starting a pool
+        results = [diff_devices(user_input, output_root, start, stop)
+                   for user_input, start, stop in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(diff_devices, user_input, output_root, start, stop, profile,
+                                       metrics.cprofile_dump('{0}.{1}'.format(user_input['name_prefix'], start)))
+                       for user_input, start, stop in tasks]
+            results = [batch.collect_metrics(future.result()) for future in futures]
+    fabrics = []
+    for result in results:
+        if fabrics and fabrics[-1][0]['name_prefix'] == result['name_prefix']:
+            fabrics[-1].append(result)
+        else:
+            fabrics.append([result])
+    return [change_set(fabric_results, output_root) for fabric_results in fabrics]
+
+
+def has_changes(change):
+    return bool(change['changed'] or change['added'] or change['removed'])
+
+
+def format_text(changes, failures=()):
+    # the unified diffs, then the change set of every fabric
+    lines = [device['diff'].rstrip('\n') for change in changes for device in change['changed']]
+    for failure in failures:
+        lines.append("FAILED  {0}: {1}".format(failure['name_prefix'], failure['error']))
+    for change in changes:
+        if not change['ok']:
+            lines.append("FAILED  {0}: {1}".format(change['name_prefix'], change['error']))
+            continue
+        lines.append("{0}: {1} changed, {2} added, {3} removed, {4} unchanged".format(
+                     change['name_prefix'], len(change['changed']), len(change['added']),
+                     len(change['removed']), change['unchanged']))
+        for device in change['changed']:
+            lines.append("  changed  {0}: {1}".format(device['filename'], ', '.join(
+                         "-{0} +{1}".format(format_range(line_range['old']), format_range(line_range['new']))
+                         for line_range in device['changes'])))
+        for device in change['added']:
+            lines.append("  added    {0}: {1} lines".format(device['filename'], device['lines']))
+        for filename in change['removed']:
+            lines.append("  removed  {0}".format(filename))
+    lines.append("{0} of {1} fabrics would change".format(
+                 len([change for change in changes if has_changes(change)]), len(changes) + len(failures)))
+    return '\n'.join(lines)
+
+
+def format_json(changes, failures=()):
+    return json.dumps({'fabrics': changes,
+                       'failures': [{'name_prefix': failure['name_prefix'], 'error': failure['error']}
+                                    for failure in failures]}, indent=1)
+
+
+def report(user_inputs, failures, output_root, workers=None, diff_format='text'):
+    # print the change sets; the exit status is 0 if nothing would change,
+    # 1 if something would and 2 if a fabric could not be compared
+    changes = diff_fabrics(user_inputs, output_root, workers)
+    if diff_format == 'json':
+        print(format_json(changes, failures))
+    else:
+        print(format_text(changes, failures))
+    if failures or not all(change['ok'] for change in changes):
+        return 2
+    if any(has_changes(change) for change in changes):
+        return 1
+    return 0
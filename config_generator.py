@@ -1,25 +1,41 @@
+import argparse
+import cProfile
 import ipaddress
 import os
 import re
 import sys
-from jinja2 import Template, Environment, FileSystemLoader
+import time
+# the executors (and multiprocessing) are only imported when first used
+import concurrent.futures
+import conflicts
+import manifest
+import metrics
+from allocator import build_address_plan
+from model import BgpPeer, BorderLeaf, FabricContext, Interface, Leaf, Link, Spine
+from output import ArchiveWriter, archive_format, write_atomic
 
 # Get operating system type (windows or non-windows) via sys.platform
 osType = sys.platform
 
-# only import readline if OS is NOT Windows
-if osType != "win32":
-    import readline
-
 
 # config directory
 homedir = os.path.realpath(os.path.split(__file__)[0])
 config_output = os.path.join(homedir, 'configs')
+# compiled template bytecode; kept between runs
+template_cache = os.path.join(homedir, '.template_cache')
 
 # Jinja global vars
 LeafTemplateFilename = 'leaf-template.j2'
 BLeafTemplateFilename = 'bleaf-template.j2'
 SpineTemplateFilename = 'spine-template.j2'
+TemplateFilenames = (LeafTemplateFilename, BLeafTemplateFilename, SpineTemplateFilename)
+# template variables with one value per fabric; template fragments using only
+# these are rendered once per fabric and reused for every device
+SharedTemplateVars = ('bgp_asn', 'ospf_area', 'multicast_group_range', 'vxlan_vrf', 'vxlan_vni_prefix',
+                      'pim_anycast_rp', 'mgmt_default_gateway', 'mgmt_ipmask')
+
+# shared render engine; created on first use
+render_engine = None
 
 # Fixed constants; used for constructing variables
 MAX_GEN1_LEAFS = 30
@@ -34,270 +50,367 @@ START_GEN1_VLAN2IP = 199
 START_GEN2_LO1IP = 70
 START_GEN2_VLAN2IP = 189
 START_VTEPIP = 150
-MGMT_MASK = '24'
 GEN1_PTP = 64
 GEN2_PTP = 128
 START_VPC = 100
 START_IF_NUM = 49
 
-
-def build_spine_vars(user_input, leaf_vars, bleaf_vars):
-    spine_mgmt_ipaddresses = []
-    spine_hostnames = []
-    spine_loopback0_ipaddresses = []
-    leaf_bgp_peers = []
-    spine_interfaces = []
-
-    mgmt_network = user_input['mgmt_subnet']
-    loopback_network = user_input['loopback_subnet']
-    ptp_network = user_input['ptp_subnet']
-
-    mgmt_default_gateway = str(mgmt_network[1])
-    pim_anycast_rp = str(loopback_network.broadcast_address)
-
-    leaf_numbers = range(1, MAX_GEN1_LEAFS + 1)
-    for bleaf in bleaf_vars:
-        leaf_bgp_peers.append({'ip': bleaf['loopback0_ip'], 'description': bleaf['hostname']})
-
-    for leaf in leaf_vars:
-        leaf_bgp_peers.append({'ip': leaf['loopback0_ip'], 'description': leaf['hostname']})
-
-    for spine in range(0, user_input['num_spines']):
-        this_spine_interfaces = []
-        spine_hostnames.append("{0}SP0{1}".format(user_input['name_prefix'], str(spine + 1)))
-        spine_mgmt_ipaddresses.append(str(mgmt_network[spine + START_SPINE_MGMTIP + 1]))
-        spine_loopback0_ipaddresses.append(str(loopback_network[spine + 33]))
-
-        for leaf_number in leaf_numbers:
-            int_portnum = 'Ethernet1/{0}'.format(leaf_number)
-            int_description = "I,{0}_{1},{2}/31,POINT-TO-POINT,area {3}".format(
-                leaf_vars[leaf_number - 1]['hostname'],
-                'Ethernet1/' + str(START_IF_NUM + spine),
-                leaf_vars[leaf_number - 1]['interfaces'][spine]['ipaddress'],
-                user_input['ospf_area'])
-            if leaf_number == 1:
-                int_ipaddress = str(ptp_network[GEN1_PTP * spine])
-            else:
-                int_ipaddress = str(ptp_network[((leaf_number - 1) * 2) + (GEN1_PTP * spine)])
-
-            this_spine_interfaces.append({'portnum': int_portnum,
-                                        'ipaddress': int_ipaddress,
-                                        'description': int_description})
-        for bleaf in range(0, 2):
-            this_bleaf_name = '{0}BL0{1}'.format(user_input['name_prefix'], str(bleaf + 1))
-            int_portnum = 'Ethernet1/{0}'.format(str(31 + bleaf))
-            int_ipaddress = str(ptp_network[(((bleaf + 31) * 2) - 2) + (GEN1_PTP * spine)])
-            int_description = "I,{0}_{1},{2}/31,POINT-TO-POINT,area {3}".format(
-                              this_bleaf_name,
-                              'Ethernet1/' + str(START_IF_NUM + spine),
-                              str(ptp_network[(((bleaf + 31) * 2) - 1) + (GEN1_PTP * spine)]),
-                              user_input['ospf_area'])
-
-            this_spine_interfaces.append({'portnum': int_portnum,
-                                        'ipaddress': int_ipaddress,
-                                        'description': int_description})
-        spine_interfaces.append(this_spine_interfaces)
-
-    spine_vars = {'spines': []}
-    for i in range(0, user_input['num_spines']):
-        spine_vars['spines'].append({'hostname': spine_hostnames[i],
-                                     'loopback0_ip': spine_loopback0_ipaddresses[i],
-                                     'pim_anycast_rp': pim_anycast_rp,
-                                     'pim_rps': spine_loopback0_ipaddresses,
-                                     'interfaces': spine_interfaces[i],
-                                     'bgp_asn': user_input['bgp_asn'],
-                                     'ospf_area': user_input['ospf_area'],
-                                     'multicast_group_range': (user_input['multicast_group_range'] + '/24'),
-                                     'leaf_bgp_peers': leaf_bgp_peers,
-                                     'mgmt_ipaddress': spine_mgmt_ipaddresses[i],
-                                     'mgmt_default_gateway': mgmt_default_gateway,
-                                     'mgmt_ipmask': MGMT_MASK,
-                                     })
-
-    return spine_vars
-
-
-def build_bleaf_vars(user_input, leaf_vars):
-    bleaf_mgmt_ipaddresses = []
-    bleaf_hostnames = []
-    bleaf_loopback0_ipaddresses = []
-    bleaf_loopback1_ipaddresses = []
-    spine_bgp_peers = leaf_vars[0]['spine_bgp_peers']
-    bleaf_interfaces = []
-
-    mgmt_network = user_input['mgmt_subnet']
-    loopback_network = user_input['loopback_subnet']
-    ptp_network = user_input['ptp_subnet']
-
-    mgmt_default_gateway = str(mgmt_network[1])
-    pim_anycast_rp = leaf_vars[0]['pim_anycast_rp']
-    vxlan_vni_prefix = leaf_vars[0]['vxlan_vni_prefix']
-
-    for bleaf in range(0, 2):
-        bleaf_mgmt_ipaddresses.append(str(mgmt_network[(bleaf + 1) + START_BLEAF_MGMTIP]))
-        bleaf_hostnames.append('{0}BL0{1}'.format(user_input['name_prefix'], str(bleaf + 1)))
-        bleaf_loopback0_ipaddresses.append(str(loopback_network[31 + bleaf]))
-        bleaf_loopback1_ipaddresses.append(str(loopback_network[131 + bleaf]))
-        this_bleaf_interfaces = []
-        for spine in range(0, user_input['num_spines']):
-            this_spine_name = '{0}SP0{1}'.format(user_input['name_prefix'], str(spine + 1))
-            int_portnum = 'Ethernet1/{0}'.format(START_IF_NUM + spine)
-            int_ipaddress = str(ptp_network[(((bleaf + 31) * 2) - 1) + (GEN1_PTP * spine)])
-            int_description = "I,{0}_{1},{2}/31,POINT-TO-POINT,area {3}".format(
-                              this_spine_name,
-                              "Ethernet1/" + str(bleaf + 31),
-                              str(ptp_network[(((bleaf + 31) * 2) - 2) + (GEN1_PTP * spine)]),
-                              user_input['ospf_area'])
-
-            this_bleaf_interfaces.append({'portnum': int_portnum,
-                                        'ipaddress': int_ipaddress,
-                                        'description': int_description})
-        bleaf_interfaces.append(this_bleaf_interfaces)
-    bleaf_vars = {'bleafs': []}
-    for i in range(0, 2):
-        bleaf_vars['bleafs'].append({'hostname': bleaf_hostnames[i],
-                                     'loopback0_ip': bleaf_loopback0_ipaddresses[i],
-                                     'loopback1_ip': bleaf_loopback1_ipaddresses[i],
-                                     'mgmt_ipaddress': bleaf_mgmt_ipaddresses[i],
-                                     'mgmt_default_gateway': mgmt_default_gateway,
-                                     'mgmt_ipmask': MGMT_MASK,
-                                     'multicast_group_range': (user_input['multicast_group_range'] + '/24'),
-                                     'ospf_area': user_input['ospf_area'],
-                                     'bgp_asn': user_input['bgp_asn'],
-                                     'vxlan_vni_prefix': vxlan_vni_prefix,
-                                     'vxlan_vrf': user_input['vxlan_vrf'],
-                                     'pim_anycast_rp': pim_anycast_rp,
-                                     'interfaces': bleaf_interfaces[i],
-                                     'spine_bgp_peers': spine_bgp_peers})
-
-    return bleaf_vars
-
-
-def build_leaf_vars(user_input):
-    vpc_domains = []
-    is_first_leaf = []
-    leaf_mgmt_ipaddresses = []
-    leaf_hostnames = []
-    leaf_loopback0_ipaddresses = []
-    leaf_loopback1_ipaddresses = []
-    leaf_loopback1_vtep_ipaddresses = []
-    peer_leafs = []
-    peer_leaf_mgmt_ipaddresses = []
-    leaf_vlan2_ipaddresses = []
-    leaf_vlan2_descriptions = []
-    spine_bgp_peers = []
-    leaf_interfaces = []
-
-    mgmt_network = user_input['mgmt_subnet']
-    loopback_network = user_input['loopback_subnet']
-    ptp_network = user_input['ptp_subnet']
-    mgmt_default_gateway = str(mgmt_network[1])
-    vxlan_vni_prefix = str(user_input['bgp_asn'])[2:]
-    pim_anycast_rp = str(user_input['loopback_subnet'].broadcast_address)
-
-    leaf_numbers = range(1, MAX_GEN1_LEAFS + 1) # list of int's 1-30
-    pair_numbers = range(1, MAX_GEN1_PAIRS + 1) # list of int's 1-15
-    for leaf_number in leaf_numbers:
-        this_leaf_interfaces = []
-        this_spine_bgp_peers = []
-        for spine in range(0, user_input['num_spines']):
-            this_spine_name = "{0}SP0{1}".format(user_input['name_prefix'], str(spine + 1))
-            int_portnum = "Ethernet1/{0}".format(START_IF_NUM + spine)
-            if leaf_number == 1:
-                int_ipaddress = str(ptp_network[leaf_number + (GEN1_PTP * spine)])
-                int_description = "I,{0}_{1},{2}/31,POINT-TO-POINT,area {3}".format(
-                                 this_spine_name,
-                                 "Ethernet1/" + str(leaf_number),
-                                 str(ptp_network[GEN1_PTP * spine]),
-                                 user_input['ospf_area'])
-            else:
-                int_ipaddress = str(ptp_network[(((leaf_number - 1) * 2) + 1) + (GEN1_PTP * spine)])
-                int_description = "I,{0}_{1},{2}/31,POINT-TO-POINT,area {3}".format(
-                                  this_spine_name,
-                                  "Ethernet1/" + str(leaf_number),
-                                  str(ptp_network[((leaf_number - 1) * 2) + (GEN1_PTP * spine)]),
-                                  user_input['ospf_area'])
-
-            this_leaf_interfaces.append({'portnum': int_portnum,
-                                         'ipaddress': int_ipaddress,
-                                         'description': int_description})
-            this_spine_bgp_peers.append({'description': this_spine_name,
-                                         'ip': '{}'.format(str(loopback_network[33 + spine]))})
-        leaf_interfaces.append(this_leaf_interfaces)
-        spine_bgp_peers.append(this_spine_bgp_peers)
-        leaf_mgmt_ipaddresses.append(str(mgmt_network[leaf_number + START_LEAF_MGMTIP]))
-        leaf_loopback0_ipaddresses.append(str(loopback_network[leaf_number]))
-        leaf_loopback1_ipaddresses.append(str(loopback_network[START_GEN1_LO1IP + leaf_number]))
-        leaf_vlan2_ipaddresses.append(str(loopback_network[START_GEN1_VLAN2IP + leaf_number]))
-        if (leaf_number % 2) > 0:
-            peer_leaf_mgmt_ipaddresses.append(str(mgmt_network[leaf_number + START_LEAF_MGMTIP + 1]))
-            is_first_leaf.append(True)
-            if leaf_number < 10:
-                leaf_hostnames.append(user_input['name_prefix'] + 'LF0' + str(leaf_number))
-                this_leaf_peer = user_input['name_prefix'] + 'LF0' + str(leaf_number + 1)
-                peer_leafs.append(this_leaf_peer)
-            else:
-                leaf_hostnames.append(user_input['name_prefix'] + 'LF' + str(leaf_number))
-                peer_leafs.append(user_input['name_prefix'] + 'LF' + str(leaf_number + 1))
-
-            leaf_vlan2_descriptions.append("I,{0}_Vlan2,{1}/31,POINT-TO-POINT,area {2}".format(
-                                           this_leaf_peer,
-                                           str(loopback_network[START_GEN1_VLAN2IP + leaf_number + 1]),
-                                           user_input['ospf_area']))
-
+# Fabric size limits
+MAX_SPINES = 4  # leaf uplinks are Ethernet1/49-52
+MAX_BLEAFS = 16
+MAX_LEAF_PAIRS = 1000 - START_VPC - 1  # vPC domain IDs run up to 1000
+DEFAULT_BLEAFS = 2
+DEFAULT_PROFILE = 'gen1'
+MIN_SUBNET_SIZE = 24  # every block is at least a /24
+
+# Generation profiles; the profile's address layout is used as long as the
+# fabric fits in it, otherwise the blocks are packed and grown (see fabric_layout)
+PROFILES = {
+    'gen1': {'max_leafs': MAX_GEN1_LEAFS,
+             'max_pairs': MAX_GEN1_PAIRS,
+             'ptp_block': GEN1_PTP,
+             'lo1_start': START_GEN1_LO1IP,
+             'vlan2_start': START_GEN1_VLAN2IP},
+    'gen2': {'max_leafs': MAX_GEN2_LEAFS,
+             'max_pairs': MAX_GEN2_PAIRS,
+             'ptp_block': GEN2_PTP,
+             'lo1_start': START_GEN2_LO1IP,
+             'vlan2_start': START_GEN2_VLAN2IP},
+}
+
+
+def prefix_for_size(num_addresses):
+    # smallest prefix length (never longer than a /24) holding num_addresses
+    prefixlen = 32 - max(num_addresses - 1, 1).bit_length()
+    return min(prefixlen, MIN_SUBNET_SIZE)
+
+
+def fabric_layout(user_input):
+    # Offsets (host indexes into the mgmt/loopback/ptp blocks) for a fabric of
+    # the requested size. user_input without size fields is a Gen1 fabric.
+    profile = PROFILES[user_input.get('profile', DEFAULT_PROFILE)]
+    num_leaf_pairs = user_input.get('num_leaf_pairs', profile['max_pairs'])
+    num_leafs = num_leaf_pairs * 2
+    num_bleafs = user_input.get('num_bleafs', DEFAULT_BLEAFS)
+    num_spines = user_input['num_spines']
+
+    # loopback block: loopback0 for leafs, border leafs then spines starting at
+    # .1, followed by the loopback1, VTEP and vlan2 ranges; the anycast RP is
+    # the broadcast address. Within the profile's layout the border leafs and
+    # spines sit after the profile's full set of leafs (and the border leafs
+    # on the spine ports after it), so they keep their addresses and ports
+    # when leaf pairs are added or removed.
+    leaf_slots = profile['max_leafs']
+    lo1_start = profile['lo1_start']
+    vtep_start = START_VTEPIP
+    vlan2_start = profile['vlan2_start']
+    if (num_leafs > leaf_slots or
+            leaf_slots + num_bleafs + num_spines > lo1_start or
+            lo1_start + leaf_slots + num_bleafs > vtep_start or
+            vtep_start + num_leaf_pairs > vlan2_start or
+            vlan2_start + num_leafs + 1 >= 2 ** (32 - MIN_SUBNET_SIZE) - 1):
+        # packed: every range starts right after the previous one
+        leaf_slots = num_leafs
+        lo1_start = num_leafs + num_bleafs + num_spines
+        vtep_start = lo1_start + num_leafs + num_bleafs
+        vlan2_start = vtep_start + num_leaf_pairs
+        if vlan2_start % 2 == 0:
+            vlan2_start += 1  # keeps each leaf pair's vlan2 /31 aligned
+    loopback_size = vlan2_start + num_leafs + 2
+
+    # one PTP /31 per spine port (leafs, then border leafs from leaf_slots + 1)
+    # on every spine, one block per spine; the block doubles once the ports
+    # no longer fit, e.g. for more than two border leafs in a full Gen1 layout
+    ptp_block = profile['ptp_block']
+    while ptp_block < (leaf_slots + num_bleafs) * 2:
+        ptp_block *= 2
+
+    leaf_mgmt_start = max(START_LEAF_MGMTIP, START_BLEAF_MGMTIP + num_bleafs)
+    mgmt_size = leaf_mgmt_start + num_leafs + 2
+
+    return {'num_leafs': num_leafs,
+            'num_leaf_pairs': num_leaf_pairs,
+            'num_bleafs': num_bleafs,
+            'num_spines': num_spines,
+            'bleaf_port_start': leaf_slots,
+            'bleaf_lo0_start': leaf_slots,
+            'spine_lo0_start': leaf_slots + num_bleafs,
+            'lo1_start': lo1_start,
+            'bleaf_lo1_start': lo1_start + leaf_slots,
+            'vtep_start': vtep_start,
+            'vlan2_start': vlan2_start,
+            'ptp_block': ptp_block,
+            'spine_mgmt_start': START_SPINE_MGMTIP,
+            'bleaf_mgmt_start': START_BLEAF_MGMTIP,
+            'leaf_mgmt_start': leaf_mgmt_start,
+            'mgmt_prefixlen': prefix_for_size(mgmt_size),
+            'loopback_prefixlen': prefix_for_size(loopback_size),
+            'ptp_prefixlen': prefix_for_size(ptp_block * num_spines)}
+
+
+def leaf_hostname(name_prefix, leaf_number):
+    return '{0}LF{1:02d}'.format(name_prefix, leaf_number)
+
+
+def bleaf_hostname(name_prefix, bleaf_number):
+    return '{0}BL{1:02d}'.format(name_prefix, bleaf_number)
+
+
+def spine_hostname(name_prefix, spine_number):
+    return '{0}SP{1:02d}'.format(name_prefix, spine_number)
+
+
+class Fabric(object):
+    # One fabric whose device variables are computed on demand. Fabric-wide
+    # values (hostnames of the spines, anycast RP, VNI prefix, BGP peer lists)
+    # are computed once and shared; a single leaf or border leaf costs
+    # O(spines) and a spine O(leafs), without building the rest of the fabric.
+    # Devices are model.Leaf/BorderLeaf/Spine records that read the shared
+    # values from one FabricContext instead of each holding a copy.
+    def __init__(self, user_input, plan=None):
+        self.user_input = user_input
+        self.layout = fabric_layout(user_input)
+        if plan is None:
+            plan = build_address_plan(user_input, self.layout, lazy=True)
+        self.plan = plan
+        self.name_prefix = user_input['name_prefix']
+        self.ospf_area = user_input['ospf_area']
+        self.vxlan_vni_prefix = str(user_input['bgp_asn'])[2:]
+        self.multicast_group_range = user_input['multicast_group_range'] + '/24'
+        self.mgmt_ipmask = str(user_input['mgmt_subnet'].prefixlen)
+        self.spine_hostnames = [spine_hostname(self.name_prefix, spine + 1)
+                                for spine in range(0, self.layout['num_spines'])]
+        # every leaf and border leaf peers with the same spines
+        self.spine_bgp_peers = [BgpPeer(self.spine_hostnames[spine], plan['spine_loopback0'][spine])
+                                for spine in range(0, self.layout['num_spines'])]
+        self.context = FabricContext(name_prefix=self.name_prefix,
+                                     bgp_asn=user_input['bgp_asn'],
+                                     ospf_area=self.ospf_area,
+                                     vxlan_vni_prefix=self.vxlan_vni_prefix,
+                                     vxlan_vrf=user_input['vxlan_vrf'],
+                                     multicast_group_range=self.multicast_group_range,
+                                     pim_anycast_rp=plan['pim_anycast_rp'],
+                                     pim_rps=plan['spine_loopback0'],
+                                     mgmt_default_gateway=plan['mgmt_default_gateway'],
+                                     mgmt_ipmask=self.mgmt_ipmask,
+                                     spine_bgp_peers=self.spine_bgp_peers)
+
+    @property
+    def leaf_bgp_peers(self):
+        # the spines' route reflector clients: border leafs, then leafs
+        if self.context.leaf_bgp_peers is None:
+            self.context.leaf_bgp_peers = (
+                [BgpPeer(bleaf_hostname(self.name_prefix, bleaf + 1), self.plan['bleaf_loopback0'][bleaf])
+                 for bleaf in range(0, self.layout['num_bleafs'])] +
+                [BgpPeer(leaf_hostname(self.name_prefix, leaf + 1), self.plan['leaf_loopback0'][leaf])
+                 for leaf in range(0, self.layout['num_leafs'])])
+        return self.context.leaf_bgp_peers
+
+    def hostnames(self):
+        return ([leaf_hostname(self.name_prefix, leaf + 1) for leaf in range(0, self.layout['num_leafs'])] +
+                [bleaf_hostname(self.name_prefix, bleaf + 1) for bleaf in range(0, self.layout['num_bleafs'])] +
+                self.spine_hostnames)
+
+    def locate(self, hostname):
+        # (template, index) of a device, parsed straight from its hostname
+        role = hostname[len(self.name_prefix):len(self.name_prefix) + 2]
+        number = hostname[len(self.name_prefix) + 2:]
+        roles = {'LF': (LeafTemplateFilename, leaf_hostname, 'num_leafs'),
+                 'BL': (BLeafTemplateFilename, bleaf_hostname, 'num_bleafs'),
+                 'SP': (SpineTemplateFilename, spine_hostname, 'num_spines')}
+        if hostname.startswith(self.name_prefix) and role in roles and number.isdigit():
+            template, format_hostname, count = roles[role]
+            index = int(number) - 1
+            if 0 <= index < self.layout[count] and format_hostname(self.name_prefix, index + 1) == hostname:
+                return template, index
+        raise KeyError("{0} is not a device of fabric {1}".format(hostname, self.name_prefix))
+
+    def lookup(self, hostname):
+        # (template, vars) of a single device
+        template, index = self.locate(hostname)
+        if template == LeafTemplateFilename:
+            return template, self.leaf_vars(index)
+        if template == BLeafTemplateFilename:
+            return template, self.bleaf_vars(index)
+        return template, self.spine_vars(index)
+
+    def device(self, hostname):
+        return self.lookup(hostname)[1]
+
+    def render(self, hostname):
+        template, vars = self.lookup(hostname)
+        return get_render_engine().render(template, vars)
+
+    def devices(self):
+        # (template, vars) for every device in output order
+        for leaf in range(0, self.layout['num_leafs']):
+            yield LeafTemplateFilename, self.timed_vars(self.leaf_vars, leaf, LeafTemplateFilename)
+        for bleaf in range(0, self.layout['num_bleafs']):
+            yield BLeafTemplateFilename, self.timed_vars(self.bleaf_vars, bleaf, BLeafTemplateFilename)
+        for spine in range(0, self.layout['num_spines']):
+            yield SpineTemplateFilename, self.timed_vars(self.spine_vars, spine, SpineTemplateFilename)
+
+    def timed_vars(self, builder, index, template):
+        # builder(index), recorded as build_<builder> of the device when profiling
+        if metrics.active is None:
+            return builder(index)
+        start = time.perf_counter()
+        vars = builder(index)
+        metrics.record('build_' + builder.__name__, time.perf_counter() - start, vars['hostname'], template)
+        return vars
+
+    def interface_description(self, hostname, portnum, ipaddress):
+        return "I,{0}_{1},{2}/31,POINT-TO-POINT,area {3}".format(hostname, portnum, ipaddress, self.ospf_area)
+
+    def interfaces(self, links):
+        # template vars of a device's uplinks
+        return [Interface(link.portnum, link.ipaddress,
+                          self.interface_description(link.peer, link.peer_portnum, link.peer_ipaddress))
+                for link in links]
+
+    # The *_links methods return the point-to-point links of one device, one
+    # model.Link per port.
+    def leaf_links(self, i):
+        links = []
+        for spine in range(0, self.layout['num_spines']):
+            ptp = self.plan['ptp'][spine]
+            links.append(Link("Ethernet1/{0}".format(START_IF_NUM + spine),
+                              ptp[(i * 2) + 1],
+                              self.spine_hostnames[spine],
+                              "Ethernet1/" + str(i + 1),
+                              ptp[i * 2]))
+        return links
+
+    def bleaf_links(self, i):
+        bleaf_port = self.layout['bleaf_port_start'] + i + 1
+        links = []
+        for spine in range(0, self.layout['num_spines']):
+            ptp = self.plan['ptp'][spine]
+            links.append(Link('Ethernet1/{0}'.format(START_IF_NUM + spine),
+                              ptp[((bleaf_port - 1) * 2) + 1],
+                              self.spine_hostnames[spine],
+                              "Ethernet1/" + str(bleaf_port),
+                              ptp[(bleaf_port - 1) * 2]))
+        return links
+
+    def spine_links(self, i):
+        ptp = self.plan['ptp'][i]
+        uplink = 'Ethernet1/' + str(START_IF_NUM + i)
+        links = []
+        for leaf in range(0, self.layout['num_leafs']):
+            links.append(Link('Ethernet1/{0}'.format(leaf + 1),
+                              ptp[leaf * 2],
+                              leaf_hostname(self.name_prefix, leaf + 1),
+                              uplink,
+                              ptp[(leaf * 2) + 1]))
+        for bleaf in range(0, self.layout['num_bleafs']):
+            bleaf_port = self.layout['bleaf_port_start'] + bleaf + 1
+            links.append(Link('Ethernet1/{0}'.format(bleaf_port),
+                              ptp[(bleaf_port - 1) * 2],
+                              bleaf_hostname(self.name_prefix, bleaf + 1),
+                              uplink,
+                              ptp[((bleaf_port - 1) * 2) + 1]))
+        return links
+
+    def leaf_vars(self, i):
+        plan = self.plan
+        leaf_number = i + 1
+        interfaces = self.interfaces(self.leaf_links(i))
+        # leafs are vPC pairs: odd leaf numbers peer with the next leaf, even with the previous
+        first_leaf = (leaf_number % 2) > 0
+        if first_leaf:
+            peer = i + 1
         else:
-            peer_leaf_mgmt_ipaddresses.append(str(mgmt_network[leaf_number + START_LEAF_MGMTIP - 1]))
-            is_first_leaf.append(False)
-            if leaf_number < 10:
-                leaf_hostnames.append(user_input['name_prefix'] + 'LF0' + str(leaf_number))
-                this_leaf_peer = user_input['name_prefix'] + 'LF0' + str(leaf_number - 1)
-                peer_leafs.append(this_leaf_peer)
-            else:
-                leaf_hostnames.append(user_input['name_prefix'] + 'LF' + str(leaf_number))
-                peer_leafs.append(user_input['name_prefix'] + 'LF' + str(leaf_number - 1))
-
-            leaf_vlan2_descriptions.append("I,{0}_Vlan2,{1}/31,POINT-TO-POINT,area {2}".format(
-                                           this_leaf_peer,
-                                           str(loopback_network[START_GEN1_VLAN2IP + leaf_number - 1]),
-                                           user_input['ospf_area']))
-
-    for pair_number in pair_numbers:
-        vpc_domains.extend([str(START_VPC + pair_number), str(START_VPC + pair_number)])
-        leaf_loopback1_vtep_ipaddresses.extend([str(loopback_network[START_VTEPIP + pair_number]), str(loopback_network[START_VTEPIP + pair_number])])
-
-    leaf_vars = {'leafs': []}
-    for i in range(0, MAX_GEN1_LEAFS):
-        leaf_vars['leafs'].append({'hostname': leaf_hostnames[i],
-                                   'first_leaf': is_first_leaf[i],
-                                   'loopback0_ip': leaf_loopback0_ipaddresses[i],
-                                   'loopback1_ip': leaf_loopback1_ipaddresses[i],
-                                   'loopback1_vtepip': leaf_loopback1_vtep_ipaddresses[i],
-                                   'vpc_domain': vpc_domains[i],
-                                   'mgmt_ipaddress': leaf_mgmt_ipaddresses[i],
-                                   'mgmt_default_gateway': mgmt_default_gateway,
-                                   'mgmt_ipmask': MGMT_MASK,
-                                   'peer_leaf_mgmt_ip': peer_leaf_mgmt_ipaddresses[i],
-                                   'peer_leaf': peer_leafs[i],
-                                   'multicast_group_range': (user_input['multicast_group_range'] + '/24'),
-                                   'ospf_area': user_input['ospf_area'],
-                                   'bgp_asn': user_input['bgp_asn'],
-                                   'vxlan_vni_prefix': vxlan_vni_prefix,
-                                   'vxlan_vrf': user_input['vxlan_vrf'],
-                                   'pim_anycast_rp': pim_anycast_rp,
-                                   'vlan2_ip': leaf_vlan2_ipaddresses[i],
-                                   'vlan2_description': leaf_vlan2_descriptions[i],
-                                   'interfaces': leaf_interfaces[i],
-                                   'spine_bgp_peers': spine_bgp_peers[i]})
-
-    return leaf_vars
+            peer = i - 1
+        peer_leaf = leaf_hostname(self.name_prefix, peer + 1)
+        vlan2_description = "I,{0}_Vlan2,{1}/31,POINT-TO-POINT,area {2}".format(
+                            peer_leaf, plan['leaf_vlan2'][peer], self.ospf_area)
+
+        return Leaf(self.context,
+                    hostname=leaf_hostname(self.name_prefix, leaf_number),
+                    first_leaf=first_leaf,
+                    loopback0_ip=plan['leaf_loopback0'][i],
+                    loopback1_ip=plan['leaf_loopback1'][i],
+                    loopback1_vtepip=plan['pair_vtep'][i // 2],
+                    vpc_domain=str(START_VPC + (i // 2) + 1),
+                    mgmt_ipaddress=plan['leaf_mgmt'][i],
+                    peer_leaf_mgmt_ip=plan['leaf_mgmt'][peer],
+                    peer_leaf=peer_leaf,
+                    vlan2_ip=plan['leaf_vlan2'][i],
+                    vlan2_description=vlan2_description,
+                    interfaces=interfaces)
+
+    def bleaf_vars(self, i):
+        plan = self.plan
+        interfaces = self.interfaces(self.bleaf_links(i))
+
+        return BorderLeaf(self.context,
+                          hostname=bleaf_hostname(self.name_prefix, i + 1),
+                          loopback0_ip=plan['bleaf_loopback0'][i],
+                          loopback1_ip=plan['bleaf_loopback1'][i],
+                          mgmt_ipaddress=plan['bleaf_mgmt'][i],
+                          interfaces=interfaces)
+
+    def spine_vars(self, i):
+        plan = self.plan
+        interfaces = self.interfaces(self.spine_links(i))
+        # fills in the shared context.leaf_bgp_peers on first use
+        self.leaf_bgp_peers
+
+        return Spine(self.context,
+                     hostname=self.spine_hostnames[i],
+                     loopback0_ip=plan['spine_loopback0'][i],
+                     mgmt_ipaddress=plan['spine_mgmt'][i],
+                     interfaces=interfaces)
+
+
+# The build_*_vars functions build every device of one role. The leaf and
+# border leaf vars arguments are no longer needed (Fabric derives the shared
+# values from the plan) and are only kept for existing callers.
+def build_spine_vars(user_input, leaf_vars, bleaf_vars, plan=None):
+    fabric = Fabric(user_input, plan)
+    return {'spines': [fabric.spine_vars(spine) for spine in range(0, fabric.layout['num_spines'])]}
+
+
+def build_bleaf_vars(user_input, leaf_vars, plan=None):
+    fabric = Fabric(user_input, plan)
+    return {'bleafs': [fabric.bleaf_vars(bleaf) for bleaf in range(0, fabric.layout['num_bleafs'])]}
+
+
+def build_leaf_vars(user_input, plan=None):
+    fabric = Fabric(user_input, plan)
+    return {'leafs': [fabric.leaf_vars(leaf) for leaf in range(0, fabric.layout['num_leafs'])]}
+
+
+def get_render_engine():
+    global render_engine
+    if render_engine is None:
+        # Jinja is only imported once something is rendered
+        from render_engine import RenderEngine
+        engine = RenderEngine(homedir, (), cache_dir=template_cache, shared_vars=SharedTemplateVars)
+        for name in TemplateFilenames:
+            with metrics.timer('compile', template=name):
+                engine.get_template(name)
+                engine.get_fragments(name)
+        render_engine = engine
+    return render_engine
+
+
+def render_chunks(engine, template, vars):
+    # the config as chunks to stream into a file; when profiling it is
+    # rendered up front so render and write are timed separately
+    if metrics.active is None:
+        return engine.generate(template, vars)
+    with metrics.timer('render', vars['hostname'], template):
+        return [engine.render(template, vars)]
 
 
 def write_template_to_file(vars,template,output_filename,output_dir):
-    env = Environment(loader=FileSystemLoader(homedir)) # Location of templates
-    output_file = open(os.path.join(output_dir,output_filename),'w')
-    template = env.get_template(template)
-    result = template.render(vars)
-    output_file.write(result)
+    engine = get_render_engine()
+    chunks = render_chunks(engine, template, vars)
+    with metrics.timer('write', vars['hostname'], template):
+        write_atomic(os.path.join(output_dir,output_filename), chunks)
+    template = engine.get_template(template)
     return "Successfully written template {0} to {1}".format(template,output_filename)
 
 
@@ -313,92 +426,205 @@ def create_fabric_directory(fabric_name, root_dir):
     return resultant_dir
 
 
-def get_user_input():
-    user_input = {}
+def parse_subnet(subnet, prefixlen=MIN_SUBNET_SIZE, field=None):
+    # Subnets are entered as a network address; an explicit /len is accepted as
+    # long as the block is at least as large as the fabric needs. field names
+    # the subnet in error messages.
+    message = "Invalid Input - must be valid subnet for Mgmt/Loopback/PTP"
+    if field is not None:
+        message = "{0} ({1})".format(message, field)
+    entered = subnet = str(subnet)
+    if '/' not in subnet:
+        subnet = '{0}/{1}'.format(subnet, prefixlen)
+    try:
+        network = ipaddress.IPv4Network(subnet)
+    except (ipaddress.AddressValueError, ValueError):
+        try:
+            # a valid address that isn't the start of a block of that size
+            network = ipaddress.IPv4Network(subnet, strict=False)
+        except (ipaddress.AddressValueError, ValueError):
+            raise ValueError("{0}: {1} is not a valid subnet".format(message, entered))
+        raise ValueError("{0}: {1} is not the start of a /{2} (it lies in {3}); fabric needs at least a /{4}".format(
+                         message, entered, network.prefixlen, network, prefixlen))
+    if network.prefixlen > prefixlen:
+        raise ValueError("{0}: {1} is too small, fabric needs at least a /{2}".format(message, network, prefixlen))
+    return network
+
+
+def validate_profile(profile):
+    profile = str(profile).lower()
+    if profile == '':
+        return DEFAULT_PROFILE
+    if profile not in PROFILES:
+        raise ValueError("Invalid Input - profile must be one of: {0}".format(', '.join(sorted(PROFILES))))
+    return profile
+
+
+def validate_count(value, minimum, maximum, name):
+    message = "Invalid Input - number of {0} must be between {1} and {2}".format(name, minimum, maximum)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(message)
+    if value < minimum or value > maximum:
+        raise ValueError(message)
+    return value
+
+
+def validate_num_leaf_pairs(num_leaf_pairs):
+    return validate_count(num_leaf_pairs, 1, MAX_LEAF_PAIRS, 'leaf pairs')
+
+
+def validate_num_bleafs(num_bleafs):
+    return validate_count(num_bleafs, 1, MAX_BLEAFS, 'border leafs')
+
+
+def validate_num_spines(num_spines):
+    return validate_count(num_spines, 1, MAX_SPINES, 'spines')
+
+
+def validate_name_prefix(name_prefix):
+    name_prefix = str(name_prefix)
+    if len(name_prefix) != 7:
+        raise ValueError("Invalid Input - prefix must be exactly seven characters (alphanumeric)")
+    return name_prefix
+
+
+def validate_bgp_asn(bgp_asn):
+    try:
+        bgp_asn = int(bgp_asn)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid Input - BGP ASN must be a number between 1 and 65535")
+    if bgp_asn < 1 or bgp_asn > 65535:
+        raise ValueError("Invalid Input - BGP ASN must be between 1 and 65535")
+    return str(bgp_asn)
+
+
+def validate_ospf_area(ospf_area):
+    ospf_area = str(ospf_area)
+    if not re.search(r'^\d+\.\d+\.\d+\.\d+$', ospf_area):
+        raise ValueError("Invalid Input - area ID must be dotted decimal")
+    return ospf_area
+
+
+def validate_multicast_group_range(multicast_group_range):
+    multicast_group_range = str(multicast_group_range)
+    try:
+        is_multicast = ipaddress.IPv4Address(multicast_group_range).is_multicast
+    except ipaddress.AddressValueError:
+        raise ValueError("Invalid Input - not a valid multicast address.")
+    if not is_multicast:
+        raise ValueError("Invalid Input - must be a valid multicast group range (Class D address)")
+    return multicast_group_range
+
+
+def validate_vxlan_vrf(vxlan_vrf):
+    vxlan_vrf = str(vxlan_vrf)
+    if vxlan_vrf == '':
+        return 'prod'
+    if len(vxlan_vrf) > 32:
+        raise ValueError("Input Invalid - name must be no more than 32 characters long")
+    return vxlan_vrf
+
+
+def validate_user_input(fabric):
+    # Validate a fabric definition (e.g. one entry of a batch spec file) with
+    # the same rules as get_user_input and return the equivalent user_input.
+    # Size fields are optional and default to a full fabric of the profile.
+    for field in ('mgmt_subnet', 'loopback_subnet', 'ptp_subnet', 'name_prefix',
+                  'num_spines', 'bgp_asn', 'ospf_area', 'multicast_group_range'):
+        if fabric.get(field) in (None, ''):
+            raise ValueError("Missing required field '{0}'".format(field))
+    def optional(field, default):
+        value = fabric.get(field)
+        if value is None or value == '':
+            return default
+        return value
+
+    profile = validate_profile(optional('profile', DEFAULT_PROFILE))
+    user_input = {'profile': profile,
+                  'num_leaf_pairs': validate_num_leaf_pairs(optional('num_leaf_pairs',
+                                                                     PROFILES[profile]['max_pairs'])),
+                  'num_bleafs': validate_num_bleafs(optional('num_bleafs', DEFAULT_BLEAFS)),
+                  'num_spines': validate_num_spines(fabric['num_spines'])}
+    layout = fabric_layout(user_input)
+    user_input.update({'mgmt_subnet': parse_subnet(fabric['mgmt_subnet'], layout['mgmt_prefixlen'], 'mgmt_subnet'),
+                       'loopback_subnet': parse_subnet(fabric['loopback_subnet'], layout['loopback_prefixlen'], 'loopback_subnet'),
+                       'ptp_subnet': parse_subnet(fabric['ptp_subnet'], layout['ptp_prefixlen'], 'ptp_subnet'),
+                       'name_prefix': validate_name_prefix(fabric['name_prefix']),
+                       'bgp_asn': validate_bgp_asn(fabric['bgp_asn']),
+                       'ospf_area': validate_ospf_area(fabric['ospf_area']),
+                       'multicast_group_range': validate_multicast_group_range(fabric['multicast_group_range']),
+                       'vxlan_vrf': validate_vxlan_vrf(fabric.get('vxlan_vrf') or '')})
+    return user_input
+
+
+def prompt(message, validator):
+    # ask until the validator accepts the answer
     while True:
-        while True:
-            try:
-                mgmt_subnet = ipaddress.IPv4Network(str(input("Mgmt Subnet [x.x.x.x]: ")+'/24'))
-                loopback_subnet = ipaddress.IPv4Network(str(input("Loopback Subnet [x.x.x.x]: ")+'/24'))
-                ptp_subnet = ipaddress.IPv4Network(str(input("PTP Subnet [x.x.x.x]: ")+'/24'))
-            except (ipaddress.AddressValueError, ValueError):
-                print("Invalid Input - must be valid subnet for Mgmt/Loopback/PTP")
-                continue
-            else:
-                break
+        try:
+            return validator(input(message))
+        except ValueError as e:
+            print(e)
 
-        while True:
-            try:
-                name_prefix = str(input("Name Prefix [first seven characters in hostnames]: "))
-                if len(name_prefix) != 7:
-                    print("Invalid Input - prefix must be exactly seven characters (alphanumeric)")
-                    continue
-                else:
-                    break
-            except ValueError:
-                print("Invalid Input - prefix must be exactly seven characters (alphanumeric)")
 
+def get_user_input():
+    # readline gives the prompts line editing; only import it if OS is NOT
+    # Windows, and only when prompting so headless modes start faster
+    if osType != "win32":
+        import readline
+    user_input = {}
+    while True:
+        profile = prompt("Generation Profile [{0}] (Leave blank for default '{1}'): ".format(
+                         ','.join(sorted(PROFILES)), DEFAULT_PROFILE), validate_profile)
+        num_leaf_pairs = prompt("Number of Leaf Pairs [1-{0}] (Leave blank for default {1}): ".format(
+                                MAX_LEAF_PAIRS, PROFILES[profile]['max_pairs']),
+                                lambda value: validate_num_leaf_pairs(value or PROFILES[profile]['max_pairs']))
+        num_spines = prompt("Number of Spines [1-{0}]: ".format(MAX_SPINES), validate_num_spines)
+        num_bleafs = prompt("Number of Border Leafs [1-{0}] (Leave blank for default {1}): ".format(
+                            MAX_BLEAFS, DEFAULT_BLEAFS),
+                            lambda value: validate_num_bleafs(value or DEFAULT_BLEAFS))
+        layout = fabric_layout({'profile': profile,
+                                'num_leaf_pairs': num_leaf_pairs,
+                                'num_bleafs': num_bleafs,
+                                'num_spines': num_spines})
         while True:
             try:
-                num_spines = int(input("Number of Spines [2,4]: "))
-            except ValueError:
-                print("Invalid Input - only the number 2 or 4 is accepted")
-                continue
-            if num_spines == 2 or num_spines == 4:
-                break
-            else:
-                print("Input Invalid - number of spines must be either 2 or 4")
-                continue
-        while True:
-            try:
-                bgp_asn = int(input("BGP ASN [1-65535]: "))
-                if bgp_asn < 1 or bgp_asn > 65535:
-                    print("Invalid Input - BGP ASN must be between 1 and 65535")
-                    continue
-                else:
-                    break
-            except ValueError:
-                print("Invalid Input - BGP ASN must be a number between 1 and 65535")
-                continue
-        while True:
-            ospf_area = str(input("OSPF Area ID [x.x.x.x]: "))
-            match_id = re.search(r'^\d+\.\d+\.\d+\.\d+$', ospf_area)
-            if not match_id:
-                print("Invalid Input - area ID must be dotted decimal")
+                mgmt_subnet = parse_subnet(input("Mgmt Subnet [x.x.x.x] (/{0}): ".format(
+                                                 layout['mgmt_prefixlen'])),
+                                           layout['mgmt_prefixlen'], 'mgmt_subnet')
+                loopback_subnet = parse_subnet(input("Loopback Subnet [x.x.x.x] (/{0}): ".format(
+                                                     layout['loopback_prefixlen'])),
+                                               layout['loopback_prefixlen'], 'loopback_subnet')
+                ptp_subnet = parse_subnet(input("PTP Subnet [x.x.x.x] (/{0}): ".format(
+                                                layout['ptp_prefixlen'])),
+                                          layout['ptp_prefixlen'], 'ptp_subnet')
+            except ValueError as e:
+                print(e)
                 continue
             else:
                 break
-        while True:
-            try:
-                multicast_group_range = str(input("VXLAN Multicast Group Subnet [x.x.x.x]: "))
-                if not ipaddress.IPv4Address(multicast_group_range).is_multicast:
-                    print("Invalid Input - must be a valid multicast group range (Class D address)")
-                    continue
-                else:
-                    break
-            except ipaddress.AddressValueError:
-                print("Invalid Input - not a valid multicast address.")
 
-        while True:
-            vxlan_vrf = str(input("VXLAN VRF Name [Max 32 characters. Leave blank for default 'prod']: "))
-            if vxlan_vrf != '' and len(vxlan_vrf) > 32:
-                print("Input Invalid - name must be no more than 32 characters long")
-                continue
-            elif vxlan_vrf == '':
-                vxlan_vrf = 'prod'
-                break
-            else:
-                break
+        name_prefix = prompt("Name Prefix [first seven characters in hostnames]: ", validate_name_prefix)
+        bgp_asn = prompt("BGP ASN [1-65535]: ", validate_bgp_asn)
+        ospf_area = prompt("OSPF Area ID [x.x.x.x]: ", validate_ospf_area)
+        multicast_group_range = prompt("VXLAN Multicast Group Subnet [x.x.x.x]: ",
+                                       validate_multicast_group_range)
+        vxlan_vrf = prompt("VXLAN VRF Name [Max 32 characters. Leave blank for default 'prod']: ",
+                           validate_vxlan_vrf)
         option = str(input("\n\tConfirm? [y/n] "))
         if option == 'y' or option == 'Y':
             user_input.update({'mgmt_subnet': mgmt_subnet,
                               'loopback_subnet': loopback_subnet,
                               'ptp_subnet': ptp_subnet,
                               'name_prefix': name_prefix,
-                              'bgp_asn': str(bgp_asn),
+                              'bgp_asn': bgp_asn,
                               'ospf_area': ospf_area,
                               'multicast_group_range': multicast_group_range,
                               'vxlan_vrf': vxlan_vrf,
+                              'profile': profile,
+                              'num_leaf_pairs': num_leaf_pairs,
+                              'num_bleafs': num_bleafs,
                               'num_spines': num_spines})
             break
         else:
@@ -407,25 +633,370 @@ def get_user_input():
     return user_input
 
 
-def generate_device_configs(user_input):
-    fabric_dir = create_fabric_directory(user_input['name_prefix'],config_output)
-    leaf_vars = build_leaf_vars(user_input)
-    for leaf in leaf_vars['leafs']:
-        print(write_template_to_file(leaf,LeafTemplateFilename,leaf['hostname']+".txt",fabric_dir))
+def remove_stale_configs(fabric_dir, old_manifest, hostnames, report):
+    # devices recorded by the previous run that are no longer part of the fabric
+    for hostname in sorted(set(old_manifest['devices']) - set(hostnames)):
+        path = os.path.join(fabric_dir, old_manifest['devices'][hostname]['filename'])
+        if os.path.isfile(path):
+            os.remove(path)
+        report['removed'].append(hostname)
+
+
+def build_device_vars(user_input):
+    # (template, vars) for every device of the fabric in output order:
+    # leafs, border leafs, then spines
+    with metrics.timer('address_plan'):
+        plan = build_address_plan(user_input, fabric_layout(user_input))
+    return Fabric(user_input, plan).devices()
+
+
+def render_device_configs(user_input):
+    # [(filename, config)] for every device, rendered in memory
+    engine = get_render_engine()
+    configs = []
+    for template, vars in build_device_vars(user_input):
+        with metrics.timer('render', vars['hostname'], template):
+            configs.append((vars['hostname'] + ".txt", engine.render(template, vars)))
+    return configs
+
+
+def render_device_config(template, vars):
+    # runs in a --jobs worker process, which keeps its own render engine;
+    # returns the config and the seconds it took to render
+    start = time.perf_counter()
+    config = get_render_engine().render(template, vars)
+    return config, time.perf_counter() - start
+
+
+def rendered_config(rendered, hostname, template):
+    # the result of render_device_config, with its render time recorded
+    config, seconds = rendered.result()
+    metrics.record('render', seconds, hostname, template)
+    return config
+
+
+def write_rendered_config(rendered, path, hostname, template):
+    # runs in a --jobs writer thread once the config has been rendered
+    config = rendered_config(rendered, hostname, template)
+    with metrics.timer('write', hostname, template):
+        write_atomic(path, [config])
+
+
+def render_in_pool(devices, renderers):
+    # [(template, vars, future of the rendered config)] for an iterable of
+    # (template, vars); every device is submitted as soon as its vars are
+    # built, so spines don't wait for leaf configs to be rendered or written
+    return [(template, vars, renderers.submit(render_device_config, template, vars))
+            for template, vars in devices]
+
+
+def write_fabric_to_archive(user_input, archive, verbose=True, jobs=None):
+    # Write every device config of the fabric into an open ArchiveWriter under
+    # <name_prefix>/. There is no manifest, so every device counts as changed.
+    # With jobs > 1 the configs are rendered in that many processes and still
+    # added to the archive in order.
+    engine = get_render_engine()
+    report = manifest.new_report()
+    if jobs and jobs > 1:
+        renderers = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+        devices = ((template, vars, [rendered_config(rendered, vars['hostname'], template)])
+                   for template, vars, rendered in render_in_pool(build_device_vars(user_input), renderers))
+    else:
+        renderers = None
+        devices = ((template, vars, render_chunks(engine, template, vars))
+                   for template, vars in build_device_vars(user_input))
+    try:
+        for template, vars, chunks in devices:
+            output_filename = vars['hostname'] + ".txt"
+            with metrics.timer('write', vars['hostname'], template):
+                archive.write(user_input['name_prefix'] + '/' + output_filename, chunks)
+            template = engine.get_template(template)
+            report['changed'].append(vars['hostname'])
+            if verbose:
+                print("Successfully written template {0} to {1}".format(template, output_filename))
+    finally:
+        if renderers is not None:
+            renderers.shutdown(cancel_futures=True)
+    return report
+
+
+def write_configs_in_parallel(devices, output_dir, jobs, verbose=True):
+    # Render (template, vars, output_filename) devices in a pool of jobs
+    # processes and write them from a pool of jobs threads. Messages are
+    # printed in the order of devices, exactly as the serial path does.
+    engine = get_render_engine()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as renderers, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as writers:
+        try:
+            writes = []
+            for template, vars, output_filename in devices:
+                rendered = renderers.submit(render_device_config, template, vars)
+                written = writers.submit(write_rendered_config, rendered,
+                                         os.path.join(output_dir, output_filename), vars['hostname'], template)
+                writes.append((template, output_filename, written))
+            for template, output_filename, written in writes:
+                written.result()
+                if verbose:
+                    print("Successfully written template {0} to {1}".format(
+                          engine.get_template(template), output_filename))
+        except BaseException:
+            renderers.shutdown(cancel_futures=True)
+            writers.shutdown(cancel_futures=True)
+            raise
+
+
+def generate_device_configs(user_input, output_root=None, verbose=True, incremental=False, jobs=None):
+    # Render and write every device of a fabric and return a report of the
+    # changed/unchanged/removed devices against the fabric's manifest. With
+    # incremental=True devices whose inputs are unchanged are not rewritten.
+    # With jobs > 1 devices are rendered and written in parallel; files,
+    # messages and report are the same as for a serial run.
+    if output_root is None:
+        output_root = config_output
+    fabric_dir = create_fabric_directory(user_input['name_prefix'],output_root)
+    engine = get_render_engine()
+    old_manifest = manifest.load_manifest(fabric_dir)
+    new_manifest = manifest.empty_manifest()
+    report = manifest.new_report()
+
+    def devices_to_write():
+        for template, vars in build_device_vars(user_input):
+            output_filename = vars['hostname'] + ".txt"
+            template_hash = engine.template_hash(template)
+            new_manifest['templates'][template] = template_hash
+            vars_hash = manifest.device_hash(vars, template_hash)
+            new_manifest['devices'][vars['hostname']] = {'template': template,
+                                                         'filename': output_filename,
+                                                         'hash': vars_hash}
+            previous = old_manifest['devices'].get(vars['hostname'])
+            if previous is not None and previous['hash'] == vars_hash:
+                report['unchanged'].append(vars['hostname'])
+                if incremental and os.path.isfile(os.path.join(fabric_dir, output_filename)):
+                    metrics.count('devices_skipped')
+                    continue
+            else:
+                report['changed'].append(vars['hostname'])
+            yield template, vars, output_filename
 
-    bleaf_vars = build_bleaf_vars(user_input, leaf_vars['leafs'])
-    for bleaf in bleaf_vars['bleafs']:
-        print(write_template_to_file(bleaf,BLeafTemplateFilename,bleaf['hostname']+".txt",fabric_dir))
+    if jobs and jobs > 1:
+        write_configs_in_parallel(devices_to_write(), fabric_dir, jobs, verbose)
+    else:
+        for template, vars, output_filename in devices_to_write():
+            result = write_template_to_file(vars,template,output_filename,fabric_dir)
+            if verbose:
+                print(result)
 
-    spine_vars = build_spine_vars(user_input, leaf_vars['leafs'], bleaf_vars['bleafs'])
-    for spine in spine_vars['spines']:
-        print(write_template_to_file(spine,SpineTemplateFilename,spine['hostname']+".txt",fabric_dir))
+    if incremental:
+        remove_stale_configs(fabric_dir, old_manifest, new_manifest['devices'], report)
+    else:
+        manifest.keep_removed_devices(old_manifest, new_manifest)
+    new_manifest['fabric'] = conflicts.fabric_record(user_input)
+    manifest.save_manifest(fabric_dir, new_manifest)
+    return report
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Generate NX-OS VXLAN EVPN fabric configurations.')
+    parser.add_argument('--spec', metavar='FILE',
+                        help='generate every fabric defined in a JSON, YAML or CSV file instead of prompting')
+    parser.add_argument('--workers', type=int, default=None, metavar='N',
+                        help='number of worker processes for --spec (default: one per CPU)')
+    parser.add_argument('--output', default=config_output, metavar='DIR',
+                        help='root output directory (default: %(default)s)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only rewrite devices whose variables or template changed since the last run')
+    parser.add_argument('--archive', metavar='FILE',
+                        help='write all configs into a single .tar.gz, .tgz or .zip file instead of --output')
+    parser.add_argument('--device', metavar='HOSTNAME',
+                        help='print the config of a single device instead of writing the fabric')
+    parser.add_argument('--check', action='store_true',
+                        help='only check the --spec fabrics (or the fabrics under --output) for overlapping '
+                             'subnets and reused identifiers')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and regenerate the --spec fabrics affected by every template or '
+                             'spec file edit')
+    parser.add_argument('--interval', type=float, default=1.0, metavar='SECONDS',
+                        help='how often --watch checks the files (default: %(default)s)')
+    parser.add_argument('--plan', metavar='FILE',
+                        help='only export the address plan, one record per device and interface, to a '
+                             '.jsonl or .csv file (- for stdout) instead of rendering configs')
+    parser.add_argument('--plan-format', choices=('jsonl', 'csv'), default=None,
+                        help='format of --plan (default: from the file extension)')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='write a JSON report of per-phase, per-template and per-device timings to FILE')
+    parser.add_argument('--cprofile', metavar='FILE',
+                        help='dump cProfile statistics of the run, including worker processes, to FILE '
+                             '(read with pstats)')
+    parser.add_argument('--jobs', type=int, default=None, metavar='N',
+                        help='render device configs in N processes and write them from N threads')
+    parser.add_argument('--diff', action='store_true',
+                        help='only compare the configs with those under --output and report what would change')
+    parser.add_argument('--diff-format', choices=('text', 'json'), default='text',
+                        help='format of the --diff report (default: %(default)s)')
+    args = parser.parse_args(argv[1:])
+    if args.archive and args.incremental:
+        parser.error('--incremental cannot be combined with --archive')
+    if args.jobs is not None and args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.plan:
+        if args.archive or args.device or args.incremental:
+            parser.error('--plan cannot be combined with --archive, --device or --incremental')
+        import plan_export
+        try:
+            plan_export.plan_format(args.plan, args.plan_format)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.watch:
+        if not args.spec:
+            parser.error('--watch requires --spec')
+        if args.archive or args.device or args.plan or args.check:
+            parser.error('--watch cannot be combined with --archive, --device, --plan or --check')
+    if args.diff and (args.archive or args.device or args.plan or args.check or args.watch or args.incremental):
+        parser.error('--diff cannot be combined with --archive, --device, --plan, --check, --watch or '
+                     '--incremental')
+    if args.jobs is not None and args.spec:
+        parser.error('--jobs applies to a single fabric; use --workers with --spec')
+    if args.cprofile and args.jobs is not None and args.jobs > 1:
+        parser.error('--cprofile cannot be combined with --jobs')
+    if args.archive:
+        try:
+            archive_format(args.archive)
+        except ValueError as e:
+            parser.error(str(e))
+    return args
+
+
+def render_single_device(hostname, spec_path=None):
+    # the fabric is picked from the spec file by its name prefix
+    if spec_path:
+        import batch
+        user_inputs = batch.validate_fabric_specs(batch.load_fabric_specs(spec_path))[0]
+        matches = [user_input for user_input in user_inputs if hostname.startswith(user_input['name_prefix'])]
+        if not matches:
+            raise KeyError("No fabric in {0} matches {1}".format(spec_path, hostname))
+        user_input = matches[0]
+    else:
+        user_input = get_user_input()
+    return Fabric(user_input).render(hostname)
 
 
 def main(argv):
+    args = parse_args(argv)
+    if args.profile:
+        metrics.enable()
+    profiler = None
+    if args.cprofile:
+        metrics.cprofile_path = args.cprofile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        return run(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            metrics.write_cprofile(profiler)
+        if args.profile:
+            metrics.write_report(args.profile, metrics.disable().report())
+
+
+def check_output_tree(output_root):
+    # --check without --spec: conflicts among the fabrics already generated
+    found = conflicts.find_conflicts(conflicts.load_fabric_tree(output_root))
+    print(conflicts.format_conflicts(found))
+    if found:
+        return 1
+    return 0
+
+
+def diff_configs(args):
+    # --diff: what generating the --spec fabrics or an interactive fabric
+    # would change under --output; nothing is written
+    import batch
+    import changeset
+    if args.spec:
+        try:
+            user_inputs, failures = batch.validate_fabric_specs(batch.load_fabric_specs(args.spec))
+        except (OSError, ValueError) as e:
+            print("Unable to read spec file {0}: {1}".format(args.spec, e))
+            return 2
+        workers = args.workers
+    else:
+        user_inputs, failures = [get_user_input()], []
+        workers = args.jobs
+    user_inputs, conflict_failures = batch.check_conflicts(user_inputs, args.output)
+    return changeset.report(user_inputs, failures + conflict_failures, args.output, workers, args.diff_format)
+
+
+def export_plan(args):
+    # --plan: the address plan of the --spec fabrics or of an interactive fabric
+    import plan_export
+    if args.spec:
+        import batch
+        try:
+            user_inputs, failures = batch.validate_fabric_specs(batch.load_fabric_specs(args.spec))
+        except (OSError, ValueError) as e:
+            print("Unable to read spec file {0}: {1}".format(args.spec, e))
+            return 2
+        user_inputs, conflict_failures = batch.check_conflicts(user_inputs)
+        failures += conflict_failures
+    else:
+        user_inputs, failures = [get_user_input()], []
+    plan_export.write_plan(args.plan, user_inputs, args.plan_format)
+    # stdout may be the plan itself
+    for failure in failures:
+        print("FAILED  {0}: {1}".format(failure['name_prefix'], failure['error']), file=sys.stderr)
+    if failures:
+        return 1
+    return 0
+
+
+def run(args):
+    if args.check:
+        if args.spec:
+            import batch
+            return batch.check(args.spec, args.output)
+        return check_output_tree(args.output)
+    if args.plan:
+        return export_plan(args)
+    if args.diff:
+        return diff_configs(args)
+    if args.watch:
+        import watch
+        return watch.watch(args.spec, args.output, args.interval)
+    if args.device:
+        try:
+            print(render_single_device(args.device, args.spec), end='')
+        except KeyError as e:
+            print(e.args[0])
+            return 1
+        except (OSError, ValueError) as e:
+            print(e)
+            return 1
+        return 0
+    if args.spec:
+        import batch
+        return batch.main(args.spec, args.output, args.workers, args.incremental, args.archive)
     user_input = get_user_input()
-    generate_device_configs(user_input)
+    if args.archive:
+        found = conflicts.find_conflicts([user_input])
+    else:
+        found = conflicts.check_fabrics([user_input], args.output)
+    found = [conflict for conflict in found if user_input['name_prefix'] in conflict['fabrics']]
+    if found:
+        print(conflicts.format_conflicts(found))
+        return 1
+    if args.archive:
+        with ArchiveWriter(args.archive) as archive:
+            write_fabric_to_archive(user_input, archive, jobs=args.jobs)
+        return
+    report = generate_device_configs(user_input, args.output, incremental=args.incremental, jobs=args.jobs)
+    if args.incremental:
+        print(manifest.format_report(user_input['name_prefix'], report))
 
 
 if __name__ == '__main__':
-    sys.exit(main(sys.argv))
+    # run main from the config_generator module that batch, plan_export and
+    # the other modules import, so they share its state (render engine,
+    # Fabric class) instead of a second copy of this script
+    import config_generator
+    sys.exit(config_generator.main(sys.argv))
@@ -0,0 +1,127 @@
+import ipaddress
+import os
+
+import manifest
+
+# Cross-fabric uniqueness checks, run before anything is rendered. Every
+# subnet of every fabric is indexed as an integer interval and checked in
+# a single sorted sweep; identifiers are grouped by value. Both are
+# O(n log n) in the number of fabrics instead of comparing fabrics pairwise.
+SUBNETS = (('mgmt_subnet', 'mgmt subnet'),
+           ('loopback_subnet', 'loopback subnet'),
+           ('ptp_subnet', 'PTP subnet'))
+
+
+def vni_prefix(user_input):
+    # same derivation as Fabric.vxlan_vni_prefix
+    return str(user_input['bgp_asn'])[2:]
+
+
+def subnet_overlaps(user_inputs):
+    # Subnets are CIDR blocks, so two of them are either disjoint or one
+    # contains the other. Sorted by start address with enclosing blocks
+    # first, every block overlapping an earlier one lies inside the block on
+    # top of the stack of still open blocks and is reported against it.
+    intervals = []
+    for user_input in user_inputs:
+        for field, kind in SUBNETS:
+            network = user_input[field]
+            intervals.append((int(network.network_address), int(network.broadcast_address),
+                              user_input['name_prefix'], kind, network))
+    intervals.sort(key=lambda interval: (interval[0], -interval[1]))
+    conflicts = []
+    open_blocks = []
+    for interval in intervals:
+        start, end, name_prefix, kind, network = interval
+        while open_blocks and open_blocks[-1][1] < start:
+            open_blocks.pop()
+        if open_blocks:
+            other = open_blocks[-1]
+            conflicts.append({'fabrics': [other[2], name_prefix],
+                              'error': "{0} {1} {2} overlaps {3} {4} {5}".format(
+                                       name_prefix, kind, network, other[2], other[3], other[4])})
+        open_blocks.append(interval)
+    return conflicts
+
+
+def duplicate_values(user_inputs, value, describe):
+    # every fabric whose value(user_input) was already used by an earlier fabric
+    first_seen = {}
+    conflicts = []
+    for user_input in user_inputs:
+        key = value(user_input)
+        if key in first_seen:
+            other = first_seen[key]
+            conflicts.append({'fabrics': [other['name_prefix'], user_input['name_prefix']],
+                              'error': describe(user_input, other)})
+        else:
+            first_seen[key] = user_input
+    return conflicts
+
+
+def find_conflicts(user_inputs):
+    # [{'fabrics': [name_prefix, name_prefix], 'error': message}] for every
+    # overlapping subnet, reused name prefix and colliding VNI prefix. vPC
+    # domain IDs are numbered per fabric and only need to be unique within a
+    # fabric, which fabric_layout already guarantees.
+    conflicts = duplicate_values(
+        user_inputs, lambda user_input: user_input['name_prefix'],
+        lambda user_input, other: "name prefix {0} is used by more than one fabric".format(
+                                  user_input['name_prefix']))
+    conflicts += duplicate_values(
+        user_inputs, vni_prefix,
+        lambda user_input, other: "{0} VNI prefix '{1}' (BGP ASN {2}) collides with {3} (BGP ASN {4})".format(
+                                  user_input['name_prefix'], vni_prefix(user_input), user_input['bgp_asn'],
+                                  other['name_prefix'], other['bgp_asn']))
+    return conflicts + subnet_overlaps(user_inputs)
+
+
+def fabric_record(user_input):
+    # the fabric definition as stored in the manifest; read back with
+    # config_generator.validate_user_input
+    record = {}
+    for field, value in user_input.items():
+        if isinstance(value, ipaddress.IPv4Network):
+            value = str(value)
+        record[field] = value
+    return record
+
+
+def load_fabric_tree(output_root):
+    # the fabrics of an existing output tree, from the definition recorded in
+    # each fabric directory's manifest; directories without one are skipped.
+    # config_generator imports this module, so import it only when needed.
+    import config_generator
+    user_inputs = []
+    if not os.path.isdir(output_root):
+        return user_inputs
+    for name in sorted(os.listdir(output_root)):
+        fabric_dir = os.path.join(output_root, name)
+        if not os.path.isdir(fabric_dir):
+            continue
+        record = manifest.load_manifest(fabric_dir).get('fabric')
+        if not record:
+            continue
+        try:
+            user_inputs.append(config_generator.validate_user_input(record))
+        except ValueError:
+            continue
+    return user_inputs
+
+
+def check_fabrics(user_inputs, output_root=None):
+    # Conflicts among user_inputs and with the fabrics already generated
+    # under output_root. An existing fabric with the same name prefix as one
+    # of user_inputs is about to be replaced, so only the new one counts.
+    names = set(user_input['name_prefix'] for user_input in user_inputs)
+    existing = []
+    if output_root is not None:
+        existing = [user_input for user_input in load_fabric_tree(output_root)
+                    if user_input['name_prefix'] not in names]
+    return find_conflicts(existing + user_inputs)
+
+
+def format_conflicts(conflicts):
+    lines = ["CONFLICT  {0}".format(conflict['error']) for conflict in conflicts]
+    lines.append("{0} conflicts found".format(len(conflicts)))
+    return '\n'.join(lines)
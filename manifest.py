@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+
+from model import Record
+from output import write_atomic
+
+# Written to each fabric directory; records what every device config was
+# rendered from so unchanged devices can be skipped on the next run.
+MANIFEST_FILENAME = '.manifest.json'
+MANIFEST_VERSION = 1
+
+
+def empty_manifest():
+    return {'version': MANIFEST_VERSION, 'templates': {}, 'devices': {}}
+
+
+def load_manifest(fabric_dir):
+    # a missing, unreadable or outdated manifest simply means "nothing is known"
+    try:
+        with open(os.path.join(fabric_dir, MANIFEST_FILENAME)) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return empty_manifest()
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        return empty_manifest()
+    return manifest
+
+
+def save_manifest(fabric_dir, manifest):
+    write_atomic(os.path.join(fabric_dir, MANIFEST_FILENAME),
+                 [json.dumps(manifest, indent=1, sort_keys=True)])
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def json_value(value):
+    # model records hash like the dicts they replace
+    if isinstance(value, Record):
+        return value.as_dict()
+    return str(value)
+
+
+def device_hash(vars, template_hash):
+    # content hash of a device's variables plus the template it is rendered with
+    return hash_text(template_hash + json.dumps(vars, sort_keys=True, separators=(',', ':'), default=json_value))
+
+
+def keep_removed_devices(old_manifest, new_manifest):
+    # carry over the devices of old_manifest that new_manifest lacks; their
+    # configs were left in place, so a later --incremental run removes them
+    for hostname, device in old_manifest['devices'].items():
+        new_manifest['devices'].setdefault(hostname, device)
+
+
+def new_report():
+    return {'changed': [], 'unchanged': [], 'removed': []}
+
+
+def format_report(name_prefix, report):
+    lines = ["{0}: {1} changed, {2} unchanged, {3} removed".format(
+             name_prefix, len(report['changed']), len(report['unchanged']), len(report['removed']))]
+    for key in ('changed', 'removed'):
+        for hostname in report[key]:
+            lines.append("  {0:<9} {1}".format(key, hostname))
+    return '\n'.join(lines)
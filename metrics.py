@@ -0,0 +1,154 @@
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+from output import write_atomic
+
+# Timers and counters for --profile. The generator calls timer(), record()
+# and count() around each builder, template compile, render and write; they
+# do nothing unless enable() has been called, so normal runs pay no cost.
+REPORT_VERSION = 1
+
+# the Metrics of the current run, if profiling
+active = None
+
+# --cprofile: the dump path of the run, and the dumps of the worker tasks
+# (<path>.<name>) that are merged into it at the end of the run
+cprofile_path = None
+cprofile_dumps = []
+
+
+def add_time(totals, phase, seconds):
+    total = totals.setdefault(phase, {'count': 0, 'seconds': 0.0})
+    total['count'] += 1
+    total['seconds'] += seconds
+
+
+def merge_times(totals, other):
+    for phase, total in other.items():
+        merged = totals.setdefault(phase, {'count': 0, 'seconds': 0.0})
+        merged['count'] += total['count']
+        merged['seconds'] += total['seconds']
+
+
+class Metrics(object):
+    # Totals per phase, per template and per device plus free-form counters.
+    # Safe to update from the --jobs writer threads.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.templates = {}
+        self.devices = {}
+        self.counters = {}
+
+    def record(self, phase, seconds, device=None, template=None):
+        with self.lock:
+            add_time(self.phases, phase, seconds)
+            if template is not None:
+                add_time(self.templates.setdefault(template, {}), phase, seconds)
+            if device is not None:
+                timings = self.devices.setdefault(device, {})
+                timings[phase] = timings.get(phase, 0.0) + seconds
+                if template is not None:
+                    timings['template'] = template
+
+    def count(self, name, increment=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + increment
+
+    def merge(self, report):
+        # add the report of another process, e.g. a batch worker
+        with self.lock:
+            merge_times(self.phases, report['phases'])
+            for template, phases in report['templates'].items():
+                merge_times(self.templates.setdefault(template, {}), phases)
+            self.devices.update(report['devices'])
+            for name, value in report['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        with self.lock:
+            return json.loads(json.dumps({'version': REPORT_VERSION,
+                                          'started': self.started,
+                                          'wall_seconds': time.perf_counter() - self.start,
+                                          'phases': self.phases,
+                                          'templates': self.templates,
+                                          'devices': self.devices,
+                                          'counters': self.counters}))
+
+
+def enable():
+    global active
+    active = Metrics()
+    return active
+
+
+def disable():
+    global active
+    metrics, active = active, None
+    return metrics
+
+
+@contextmanager
+def timer(phase, device=None, template=None):
+    if active is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - start, device, template)
+
+
+def record(phase, seconds, device=None, template=None):
+    if active is not None:
+        active.record(phase, seconds, device, template)
+
+
+def count(name, increment=1):
+    if active is not None:
+        active.count(name, increment)
+
+
+def write_report(path, report):
+    write_atomic(path, [json.dumps(report, indent=1, sort_keys=True)])
+
+
+def cprofile_dump(name):
+    # the path a worker task dumps its cProfile statistics to, or None
+    if cprofile_path is None:
+        return None
+    path = '{0}.{1}'.format(cprofile_path, name)
+    cprofile_dumps.append(path)
+    return path
+
+
+@contextmanager
+def cprofiled(path):
+    # runs in a worker: cProfile the block and dump it to path, if given
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+
+def write_cprofile(profiler):
+    # the main process's statistics plus those of every worker task
+    stats = pstats.Stats(profiler)
+    for path in cprofile_dumps:
+        if os.path.exists(path):
+            stats.add(path)
+    stats.dump_stats(cprofile_path)
@@ -0,0 +1,198 @@
+import sys
+from collections.abc import Mapping
+
+# Compact device model. Values common to a whole fabric are held once by a
+# FabricContext that all of its devices point to; a device only holds its
+# own values in __slots__. Devices and their interface and BGP peer records
+# are read-only mappings with exactly the keys the templates use, so they
+# are rendered, hashed and looked up in place without per-device dict copies.
+
+
+class Record(Mapping):
+    # A mapping over the attributes named in fields. Subclasses declare the
+    # attributes as __slots__ and list the keys in fields and field_set.
+    __slots__ = ()
+    fields = ()
+    field_set = frozenset()
+
+    def __getitem__(self, key):
+        if key in self.field_set:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.field_set
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, self.as_dict())
+
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, field) for field in self.__slots__))
+
+    def as_dict(self):
+        # a plain dict copy, faster than dict(record)
+        return {field: getattr(self, field) for field in self.fields}
+
+
+def record_fields(*fields):
+    return fields, frozenset(fields)
+
+
+# port names repeat across every device of every fabric and are interned
+class Interface(Record):
+    # a routed uplink as seen by the templates
+    __slots__ = ('portnum', 'ipaddress', 'description')
+    fields, field_set = record_fields(*__slots__)
+
+    def __init__(self, portnum, ipaddress, description):
+        self.portnum = sys.intern(portnum)
+        self.ipaddress = ipaddress
+        self.description = description
+
+
+class Link(Record):
+    # one point-to-point link from one end: local port and address, and the
+    # peer device, port and address
+    __slots__ = ('portnum', 'ipaddress', 'peer', 'peer_portnum', 'peer_ipaddress')
+    fields, field_set = record_fields(*__slots__)
+
+    def __init__(self, portnum, ipaddress, peer, peer_portnum, peer_ipaddress):
+        self.portnum = sys.intern(portnum)
+        self.ipaddress = ipaddress
+        self.peer = peer
+        self.peer_portnum = sys.intern(peer_portnum)
+        self.peer_ipaddress = peer_ipaddress
+
+
+class BgpPeer(Record):
+    # a BGP neighbor; one list of these is shared by all devices of a fabric
+    __slots__ = ('description', 'ip')
+    fields, field_set = record_fields(*__slots__)
+
+    def __init__(self, description, ip):
+        self.description = description
+        self.ip = ip
+
+
+class FabricContext(object):
+    # the values every device of a fabric shares
+    __slots__ = ('name_prefix', 'bgp_asn', 'ospf_area', 'vxlan_vni_prefix', 'vxlan_vrf',
+                 'multicast_group_range', 'pim_anycast_rp', 'pim_rps', 'mgmt_default_gateway',
+                 'mgmt_ipmask', 'spine_bgp_peers', 'leaf_bgp_peers')
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+
+class Device(Record):
+    # A device's own values in __slots__ plus the shared_fields of its role,
+    # read from the fabric context. fields keeps the key order of the old dicts.
+    __slots__ = ('context',)
+    shared_fields = ()
+    shared_field_set = frozenset()
+
+    def __getitem__(self, key):
+        if key in self.shared_field_set:
+            return getattr(self.context, key)
+        if key in self.field_set:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __getattr__(self, name):
+        # only called for names that are not slots of the device
+        if name in type(self).shared_field_set:
+            return getattr(self.context, name)
+        raise AttributeError(name)
+
+    def __reduce__(self):
+        # Only the shared values this role uses are pickled with it, not the
+        # whole context, so a device sent to a render process costs no more
+        # than the dict it replaces.
+        return (rebuild_device, (type(self), tuple(getattr(self, field) for field in type(self).__slots__),
+                                 tuple(getattr(self.context, field) for field in self.shared_fields)))
+
+    def as_dict(self):
+        context = self.context
+        shared_field_set = self.shared_field_set
+        return {field: getattr(context if field in shared_field_set else self, field) for field in self.fields}
+
+
+def rebuild_device(role, values, shared_values):
+    # the role's __init__ takes the context and then its __slots__ in order
+    return role(FabricContext(**dict(zip(role.shared_fields, shared_values))), *values)
+
+
+def device_fields(shared, order):
+    # (fields, field_set, shared_fields, shared_field_set) of a device role;
+    # order lists its __slots__ and the shared fields in the key order
+    return tuple(order), frozenset(order), tuple(shared), frozenset(shared)
+
+
+class Leaf(Device):
+    __slots__ = ('hostname', 'first_leaf', 'loopback0_ip', 'loopback1_ip', 'loopback1_vtepip', 'vpc_domain',
+                 'mgmt_ipaddress', 'peer_leaf_mgmt_ip', 'peer_leaf', 'vlan2_ip', 'vlan2_description',
+                 'interfaces')
+    fields, field_set, shared_fields, shared_field_set = device_fields(
+        ('mgmt_default_gateway', 'mgmt_ipmask', 'multicast_group_range', 'ospf_area', 'bgp_asn',
+         'vxlan_vni_prefix', 'vxlan_vrf', 'pim_anycast_rp', 'spine_bgp_peers'),
+        ('hostname', 'first_leaf', 'loopback0_ip', 'loopback1_ip', 'loopback1_vtepip', 'vpc_domain',
+         'mgmt_ipaddress', 'mgmt_default_gateway', 'mgmt_ipmask', 'peer_leaf_mgmt_ip', 'peer_leaf',
+         'multicast_group_range', 'ospf_area', 'bgp_asn', 'vxlan_vni_prefix', 'vxlan_vrf', 'pim_anycast_rp',
+         'vlan2_ip', 'vlan2_description', 'interfaces', 'spine_bgp_peers'))
+
+    def __init__(self, context, hostname, first_leaf, loopback0_ip, loopback1_ip, loopback1_vtepip, vpc_domain,
+                 mgmt_ipaddress, peer_leaf_mgmt_ip, peer_leaf, vlan2_ip, vlan2_description, interfaces):
+        self.context = context
+        self.hostname = hostname
+        self.first_leaf = first_leaf
+        self.loopback0_ip = loopback0_ip
+        self.loopback1_ip = loopback1_ip
+        self.loopback1_vtepip = loopback1_vtepip
+        self.vpc_domain = vpc_domain
+        self.mgmt_ipaddress = mgmt_ipaddress
+        self.peer_leaf_mgmt_ip = peer_leaf_mgmt_ip
+        self.peer_leaf = peer_leaf
+        self.vlan2_ip = vlan2_ip
+        self.vlan2_description = vlan2_description
+        self.interfaces = interfaces
+
+
+class BorderLeaf(Device):
+    __slots__ = ('hostname', 'loopback0_ip', 'loopback1_ip', 'mgmt_ipaddress', 'interfaces')
+    fields, field_set, shared_fields, shared_field_set = device_fields(
+        ('mgmt_default_gateway', 'mgmt_ipmask', 'multicast_group_range', 'ospf_area', 'bgp_asn',
+         'vxlan_vni_prefix', 'vxlan_vrf', 'pim_anycast_rp', 'spine_bgp_peers'),
+        ('hostname', 'loopback0_ip', 'loopback1_ip', 'mgmt_ipaddress', 'mgmt_default_gateway', 'mgmt_ipmask',
+         'multicast_group_range', 'ospf_area', 'bgp_asn', 'vxlan_vni_prefix', 'vxlan_vrf', 'pim_anycast_rp',
+         'interfaces', 'spine_bgp_peers'))
+
+    def __init__(self, context, hostname, loopback0_ip, loopback1_ip, mgmt_ipaddress, interfaces):
+        self.context = context
+        self.hostname = hostname
+        self.loopback0_ip = loopback0_ip
+        self.loopback1_ip = loopback1_ip
+        self.mgmt_ipaddress = mgmt_ipaddress
+        self.interfaces = interfaces
+
+
+class Spine(Device):
+    __slots__ = ('hostname', 'loopback0_ip', 'mgmt_ipaddress', 'interfaces')
+    fields, field_set, shared_fields, shared_field_set = device_fields(
+        ('pim_anycast_rp', 'pim_rps', 'bgp_asn', 'ospf_area', 'multicast_group_range', 'leaf_bgp_peers',
+         'mgmt_default_gateway', 'mgmt_ipmask'),
+        ('hostname', 'loopback0_ip', 'pim_anycast_rp', 'pim_rps', 'interfaces', 'bgp_asn', 'ospf_area',
+         'multicast_group_range', 'leaf_bgp_peers', 'mgmt_ipaddress', 'mgmt_default_gateway', 'mgmt_ipmask'))
+
+    def __init__(self, context, hostname, loopback0_ip, mgmt_ipaddress, interfaces):
+        self.context = context
+        self.hostname = hostname
+        self.loopback0_ip = loopback0_ip
+        self.mgmt_ipaddress = mgmt_ipaddress
+        self.interfaces = interfaces
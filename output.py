@@ -0,0 +1,104 @@
+import io
+import os
+import tarfile
+import tempfile
+import time
+import zipfile
+
+# write buffer for config files; a device config is usually well under this
+BUFFER_SIZE = 64 * 1024
+
+ARCHIVE_FORMATS = ('.tar.gz', '.tgz', '.zip')
+
+
+def current_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# read once; os.umask() is process wide and not safe to toggle from threads
+UMASK = current_umask()
+
+
+def write_atomic(path, chunks):
+    # Stream chunks (e.g. template.generate()) into a buffered temp file next
+    # to path and rename it into place, so path is either the old or the
+    # complete new file, never a partial one.
+    directory, filename = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(prefix='.' + filename + '.', suffix='.tmp', dir=directory)
+    try:
+        with io.open(fd, 'w', buffering=BUFFER_SIZE, encoding='utf-8') as output_file:
+            for chunk in chunks:
+                output_file.write(chunk)
+        os.chmod(temp_path, 0o666 & ~UMASK)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def archive_format(path):
+    for extension in ARCHIVE_FORMATS:
+        if path.lower().endswith(extension):
+            return extension
+    raise ValueError("Unsupported archive type for {0} - use {1}".format(path, ', '.join(ARCHIVE_FORMATS)))
+
+
+class ArchiveWriter(object):
+    # Writes configs for one or more fabrics into a single tar.gz or zip file
+    # in one pass. The archive is built under a temporary name and only
+    # renamed to path once it is complete.
+    def __init__(self, path):
+        self.path = path
+        self.format = archive_format(path)
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, self.temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.',
+                                              suffix='.tmp', dir=directory)
+        self.file = io.open(fd, 'wb', buffering=BUFFER_SIZE)
+        if self.format == '.zip':
+            self.archive = zipfile.ZipFile(self.file, 'w', zipfile.ZIP_DEFLATED)
+        else:
+            self.archive = tarfile.open(fileobj=self.file, mode='w:gz')
+
+    def write(self, name, chunks):
+        # name is the member path inside the archive, e.g. DC1SFRM/DC1SFRMLF01.txt
+        if self.format == '.zip':
+            with self.archive.open(name, 'w') as member:
+                for chunk in chunks:
+                    member.write(chunk.encode('utf-8'))
+        else:
+            data = ''.join(chunks).encode('utf-8')
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            member.mtime = int(time.time())
+            member.mode = 0o644
+            self.archive.addfile(member, io.BytesIO(data))
+
+    def close(self):
+        try:
+            self.archive.close()
+            self.file.close()
+        except BaseException:
+            self.abort()
+            raise
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        # drop the partial archive; path keeps any previous archive
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
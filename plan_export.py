@@ -0,0 +1,124 @@
+import csv
+import io
+import json
+import os
+import sys
+
+import config_generator
+from output import write_atomic
+
+# Exports the address plan of one or more fabrics without rendering any
+# configs: one record per device and one per point-to-point interface,
+# streamed fabric by fabric so memory stays flat for large batches.
+PLAN_FORMATS = ('jsonl', 'csv')
+PLAN_FIELDS = ('fabric', 'record', 'role', 'hostname', 'mgmt_ip', 'loopback0_ip', 'loopback1_ip',
+               'vtep_ip', 'vlan2_ip', 'vpc_domain', 'vpc_peer', 'bgp_peers',
+               'interface', 'ip_address', 'peer', 'peer_interface', 'peer_ip')
+
+
+def plan_format(path, requested=None):
+    # the requested format, else the file extension; stdout ('-') defaults to JSON Lines
+    plan_format = requested
+    if plan_format is None:
+        extension = os.path.splitext(path)[1].lower()
+        if extension in ('.jsonl', '.csv'):
+            plan_format = extension[1:]
+        elif path == '-':
+            plan_format = 'jsonl'
+        else:
+            raise ValueError("Unsupported plan file type for {0} - use .jsonl or .csv".format(path))
+    if plan_format not in PLAN_FORMATS:
+        raise ValueError("Unsupported plan format '{0}' - use {1}".format(plan_format, ', '.join(PLAN_FORMATS)))
+    return plan_format
+
+
+def device_records(fabric, role, vars, links):
+    # the device record followed by a record per interface
+    record = {'fabric': fabric.name_prefix,
+              'record': 'device',
+              'role': role,
+              'hostname': vars['hostname'],
+              'mgmt_ip': vars['mgmt_ipaddress'],
+              'loopback0_ip': vars['loopback0_ip']}
+    if 'loopback1_ip' in vars:
+        record['loopback1_ip'] = vars['loopback1_ip']
+    if 'loopback1_vtepip' in vars:
+        record.update({'vtep_ip': vars['loopback1_vtepip'],
+                       'vlan2_ip': vars['vlan2_ip'],
+                       'vpc_domain': vars['vpc_domain'],
+                       'vpc_peer': vars['peer_leaf']})
+    if 'spine_bgp_peers' in vars:
+        record['bgp_peers'] = [peer['ip'] for peer in vars['spine_bgp_peers']]
+    else:
+        record['bgp_peers'] = [peer['ip'] for peer in vars['leaf_bgp_peers']]
+    yield record
+    for link in links:
+        yield {'fabric': fabric.name_prefix,
+               'record': 'interface',
+               'role': role,
+               'hostname': vars['hostname'],
+               'interface': link['portnum'],
+               'ip_address': link['ipaddress'],
+               'peer': link['peer'],
+               'peer_interface': link['peer_portnum'],
+               'peer_ip': link['peer_ipaddress']}
+
+
+def fabric_records(fabric):
+    # records of one Fabric in output order: leafs, border leafs, then spines
+    for leaf in range(0, fabric.layout['num_leafs']):
+        for record in device_records(fabric, 'leaf', fabric.leaf_vars(leaf), fabric.leaf_links(leaf)):
+            yield record
+    for bleaf in range(0, fabric.layout['num_bleafs']):
+        for record in device_records(fabric, 'bleaf', fabric.bleaf_vars(bleaf), fabric.bleaf_links(bleaf)):
+            yield record
+    for spine in range(0, fabric.layout['num_spines']):
+        for record in device_records(fabric, 'spine', fabric.spine_vars(spine), fabric.spine_links(spine)):
+            yield record
+
+
+def plan_records(user_inputs):
+    # records of every fabric, one fabric at a time
+    for user_input in user_inputs:
+        fabric = config_generator.Fabric(user_input, config_generator.build_address_plan(
+                                         user_input, config_generator.fabric_layout(user_input)))
+        for record in fabric_records(fabric):
+            yield record
+
+
+def jsonl_lines(records):
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+
+def csv_lines(records):
+    # lists (BGP peers) are space separated; fields a record lacks are empty
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, PLAN_FIELDS, lineterminator='\n')
+    writer.writeheader()
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    for record in records:
+        if 'bgp_peers' in record:
+            record['bgp_peers'] = ' '.join(record['bgp_peers'])
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def plan_lines(records, plan_format):
+    if plan_format == 'csv':
+        return csv_lines(records)
+    return jsonl_lines(records)
+
+
+def write_plan(path, user_inputs, requested_format=None):
+    # stream the plan to path, or to stdout if path is '-'
+    lines = plan_lines(plan_records(user_inputs), plan_format(path, requested_format))
+    if path == '-':
+        for line in lines:
+            sys.stdout.write(line)
+    else:
+        write_atomic(path, lines)
@@ -0,0 +1,266 @@
+import hashlib
+import os
+import threading
+from collections import ChainMap, OrderedDict
+from jinja2 import BaseLoader, Environment, FileSystemLoader, FileSystemBytecodeCache, TemplateNotFound, meta
+
+import metrics
+
+# "<template>#<n>" names fragment n of <template> (see FragmentLoader)
+FRAGMENT_SEPARATOR = '#'
+DEFAULT_FRAGMENT_CACHE_SIZE = 1024
+# shared runs shorter than this are rendered along with the device lines
+MIN_SHARED_FRAGMENT_LINES = 20
+
+# block statements that must be closed by a matching end tag
+BLOCK_STATEMENTS = ('for', 'if', 'macro', 'call', 'filter', 'block', 'with', 'autoescape', 'raw', 'trans')
+# statements with effects beyond their own lines; templates using them are not split
+UNSPLITTABLE_STATEMENTS = ('set', 'extends', 'import', 'from', 'include', 'macro', 'block')
+
+# stands in for a variable missing from a device's vars in fragment cache keys
+MISSING = object()
+
+
+def device_context(template, vars):
+    # A render context that looks the variables up in vars, which may be a
+    # model record, instead of copying them into a new dict per render.
+    return template.new_context(ChainMap(vars, template.globals), shared=True)
+
+
+def unsplittable_spans(env, source):
+    # (first, last) line numbers of every top-level block statement and of
+    # every tag spanning several lines; a template can't be cut inside these.
+    # Returns None if the template can't be split at all.
+    spans = []
+    depth = 0
+    tag_start = None
+    block_start = None
+    expect_keyword = False
+    for lineno, token, value in env.lex(source):
+        if token in ('block_begin', 'variable_begin', 'comment_begin', 'raw_begin'):
+            tag_start = lineno
+            expect_keyword = token == 'block_begin'
+        elif expect_keyword and token == 'name':
+            expect_keyword = False
+            if value in UNSPLITTABLE_STATEMENTS:
+                return None
+            if value in BLOCK_STATEMENTS:
+                if depth == 0:
+                    block_start = tag_start
+                depth += 1
+            elif value.startswith('end') and value[3:] in BLOCK_STATEMENTS:
+                depth -= 1
+                if depth == 0:
+                    spans.append((block_start, lineno))
+        elif token in ('block_end', 'variable_end', 'comment_end', 'raw_end'):
+            if lineno > tag_start:
+                spans.append((tag_start, lineno))
+            tag_start = None
+    return spans
+
+
+def split_source(env, source):
+    # Cut a template into top-level line chunks whose concatenation is the
+    # original source. A chunk only ends after a non-blank line and the newline
+    # moves to the start of the next chunk, so no chunk but the last ends with
+    # a newline and Jinja's trailing newline stripping behaves exactly as it
+    # does for the whole template.
+    lines = source.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    spans = unsplittable_spans(env, '\n'.join(lines))
+    if spans is None:
+        return [source]
+    joined = set()
+    for first, last in spans:
+        joined.update(range(first, last))  # line k continues on line k + 1
+    chunks = [[]]
+    for lineno, line in enumerate(lines, 1):
+        chunks[-1].append(line)
+        if line != '' and lineno not in joined:
+            chunks.append([])
+    if not chunks[-1]:
+        chunks.pop()
+    sources = ['\n'.join(chunks[0])]
+    for chunk in chunks[1:]:
+        sources.append('\n' + '\n'.join(chunk))
+    return sources
+
+
+def merge_fragments(fragments):
+    # join consecutive [source, shared, names] entries of the same kind;
+    # the merged entries are the ones passed in, extended in place
+    merged = []
+    for fragment in fragments:
+        if merged and merged[-1][1] == fragment[1]:
+            merged[-1][0] += fragment[0]
+            merged[-1][2] |= fragment[2]
+        else:
+            merged.append(fragment)
+    return merged
+
+
+class FragmentLoader(BaseLoader):
+    # Loads whole templates from template_dir and, for "<template>#<n>", the
+    # n-th fragment of a template as computed by RenderEngine. Fragments get
+    # a name of their own so they are compiled once and share the bytecode cache.
+    def __init__(self, template_dir):
+        self.loader = FileSystemLoader(template_dir)
+        self.fragments = {}
+
+    def get_source(self, environment, template):
+        name, separator, index = template.rpartition(FRAGMENT_SEPARATOR)
+        if separator and name in self.fragments:
+            sources = self.fragments[name]
+            if index.isdigit() and int(index) < len(sources):
+                return sources[int(index)], None, lambda: True
+            raise TemplateNotFound(template)
+        return self.loader.get_source(environment, template)
+
+
+class BytecodeCache(FileSystemBytecodeCache):
+    # The bytecode cache only saves compile time: a cache directory that
+    # can't be written (e.g. a read-only checkout) just means no caching.
+    def dump_bytecode(self, bucket):
+        try:
+            FileSystemBytecodeCache.dump_bytecode(self, bucket)
+        except OSError:
+            pass
+
+
+class RenderEngine(object):
+    # Owns a single Jinja Environment and the compiled device templates.
+    # Templates are compiled once per process; with a cache_dir the compiled
+    # bytecode is also kept on disk and reused until the template changes.
+    #
+    # Templates are also split into fragments: runs of lines that only use
+    # shared_vars (values common to a whole fabric) are rendered once per
+    # distinct set of values and kept in an LRU cache, and only the fragments
+    # using per-device values are rendered for every device.
+    def __init__(self, template_dir, template_names, cache_dir=None, shared_vars=(),
+                 fragment_cache_size=DEFAULT_FRAGMENT_CACHE_SIZE):
+        bytecode_cache = None
+        if cache_dir is not None:
+            try:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                bytecode_cache = BytecodeCache(cache_dir)
+            except OSError:
+                cache_dir = None
+        self.template_dir = template_dir
+        self.cache_dir = cache_dir
+        self.loader = FragmentLoader(template_dir)
+        self.env = Environment(loader=self.loader,
+                               bytecode_cache=bytecode_cache,
+                               auto_reload=False)
+        self.shared_vars = frozenset(shared_vars)
+        self.fragment_cache_size = fragment_cache_size
+        self.fragment_cache = OrderedDict()
+        self.fragment_lock = threading.Lock()
+        self.templates = {}
+        self.template_fragments = {}
+        self.template_hashes = {}
+        for name in template_names:
+            self.get_template(name)
+
+    def get_template(self, name):
+        template = self.templates.get(name)
+        if template is None:
+            template = self.env.get_template(name)
+            self.templates[name] = template
+        return template
+
+    def reload(self, name):
+        # forget everything compiled or cached for template name and compile
+        # it again from the (edited) file; raises if it no longer compiles
+        self.templates.pop(name, None)
+        self.template_hashes.pop(name, None)
+        self.template_fragments.pop(name, None)
+        self.loader.fragments.pop(name, None)
+        self.env.cache.clear()
+        with self.fragment_lock:
+            for key in [key for key in self.fragment_cache
+                        if key[0].rpartition(FRAGMENT_SEPARATOR)[0] == name]:
+                del self.fragment_cache[key]
+        template = self.get_template(name)
+        if self.fragment_cache_size:
+            self.get_fragments(name)
+        return template
+
+    def template_hash(self, name):
+        # hash of the template source; changes whenever the template is edited
+        template_hash = self.template_hashes.get(name)
+        if template_hash is None:
+            source = self.env.loader.get_source(self.env, name)[0]
+            template_hash = hashlib.sha256(source.encode('utf-8')).hexdigest()
+            self.template_hashes[name] = template_hash
+        return template_hash
+
+    def template_names(self, source):
+        # undeclared variables of a piece of template source
+        if not any(start in source for start in (self.env.block_start_string,
+                                                 self.env.variable_start_string,
+                                                 self.env.comment_start_string)):
+            return set()
+        return set(meta.find_undeclared_variables(self.env.parse(source)))
+
+    def get_fragments(self, name):
+        # [(template, shared variable names or None)] in output order; None
+        # marks a fragment that has to be rendered for every device
+        fragments = self.template_fragments.get(name)
+        if fragments is None:
+            sources = []
+            for source in split_source(self.env, self.env.loader.get_source(self.env, name)[0]):
+                names = self.template_names(source)
+                sources.append([source, names <= self.shared_vars, names])
+            # short shared runs between per-device lines cost more as separate
+            # renders than they save; only long runs are cached
+            sources = merge_fragments(sources)
+            for fragment in sources:
+                if fragment[1] and fragment[0].count('\n') < MIN_SHARED_FRAGMENT_LINES:
+                    fragment[1] = False
+            sources = merge_fragments(sources)
+            self.loader.fragments[name] = [source for source, shared, names in sources]
+            fragments = []
+            for index, (source, shared, names) in enumerate(sources):
+                template = self.env.get_template(name + FRAGMENT_SEPARATOR + str(index))
+                if shared:
+                    fragments.append((template, tuple(sorted(names))))
+                else:
+                    fragments.append((template, None))
+            self.template_fragments[name] = fragments
+        return fragments
+
+    def cached_fragment(self, template, names, vars):
+        key = (template.name,) + tuple(vars.get(name, MISSING) for name in names)
+        with self.fragment_lock:
+            text = self.fragment_cache.get(key)
+            if text is not None:
+                self.fragment_cache.move_to_end(key)
+                metrics.count('fragment_cache_hits')
+                return text
+        metrics.count('fragment_cache_misses')
+        text = self.env.concat(template.root_render_func(device_context(template, vars)))
+        with self.fragment_lock:
+            self.fragment_cache[key] = text
+            while len(self.fragment_cache) > self.fragment_cache_size:
+                self.fragment_cache.popitem(last=False)
+        return text
+
+    def generate(self, name, vars):
+        # the rendered config as a stream of chunks
+        if not self.fragment_cache_size:
+            template = self.get_template(name)
+            for chunk in template.root_render_func(device_context(template, vars)):
+                yield chunk
+            return
+        context = None
+        for template, names in self.get_fragments(name):
+            if names is None:
+                # one context per device, shared by all of its fragments
+                if context is None:
+                    context = device_context(template, vars)
+                yield self.env.concat(template.root_render_func(context))
+            else:
+                yield self.cached_fragment(template, names, vars)
+
+    def render(self, name, vars):
+        return ''.join(self.generate(name, vars))
@@ -0,0 +1,355 @@
+import argparse
+import errno
+import http.client
+import http.server
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+from collections import OrderedDict
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+import batch
+import config_generator
+import conflicts
+import manifest
+import plan_export
+from allocator import build_address_plan
+from output import write_atomic
+
+# Long-running render service. Templates stay compiled and fabric plans are
+# kept in an LRU cache, so a request costs milliseconds instead of a new
+# interpreter. Requests carry fabric definitions in the spec file format:
+#   GET  /health                     {"ok": true, ...}
+#   POST /fabric        <fabric>     {"name_prefix": ..., "configs": {filename: config}, "manifest": ...}
+#   POST /device/<hostname> <fabric> the device config as text
+#   POST /plan[?format=csv] <fabric or list of fabrics>  the plan as JSON Lines or CSV
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8179
+DEFAULT_FABRIC_CACHE_SIZE = 128
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+
+
+class FabricCache(object):
+    # LRU cache of Fabric objects keyed by the validated fabric definition,
+    # so repeated requests for a fabric reuse its address plan
+    def __init__(self, size=DEFAULT_FABRIC_CACHE_SIZE):
+        self.size = size
+        self.fabrics = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.fabrics)
+
+    def get(self, spec):
+        if not isinstance(spec, dict):
+            raise ValueError("Fabric definition must be a mapping of field names to values")
+        user_input = config_generator.validate_user_input(spec)
+        key = json.dumps(conflicts.fabric_record(user_input), sort_keys=True)
+        with self.lock:
+            fabric = self.fabrics.get(key)
+            if fabric is not None:
+                self.fabrics.move_to_end(key)
+                return fabric
+        fabric = config_generator.Fabric(user_input, build_address_plan(
+                                         user_input, config_generator.fabric_layout(user_input)))
+        with self.lock:
+            self.fabrics[key] = fabric
+            while len(self.fabrics) > self.size:
+                self.fabrics.popitem(last=False)
+        return fabric
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # responses are written as headers + body; don't let Nagle delay the body
+    disable_nagle_algorithm = True
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def send(self, status, content_type, text):
+        data = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, status, value):
+        self.send(status, 'application/json', json.dumps(value))
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_REQUEST_SIZE:
+            raise ValueError("Request body is larger than {0} bytes".format(MAX_REQUEST_SIZE))
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def do_GET(self):
+        if urlsplit(self.path).path != '/health':
+            self.send_json(404, {'error': "Unknown path {0}".format(self.path)})
+            return
+        self.send_json(200, {'ok': True, 'fabrics_cached': len(self.server.fabrics)})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        try:
+            spec = self.read_json()
+            if url.path == '/fabric':
+                self.send_json(200, render_fabric(self.server.fabrics.get(spec)))
+            elif url.path.startswith('/device/'):
+                fabric = self.server.fabrics.get(spec)
+                self.send(200, 'text/plain', fabric.render(unquote(url.path[len('/device/'):])))
+            elif url.path == '/plan':
+                self.send(200, 'text/plain', render_plan(self.server.fabrics, spec,
+                                                         parse_qs(url.query).get('format', [None])[0]))
+            else:
+                self.send_json(404, {'error': "Unknown path {0}".format(url.path)})
+        except KeyError as e:
+            self.send_json(404, {'error': e.args[0]})
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+        except Exception as e:
+            self.send_json(500, {'error': '{0}: {1}'.format(type(e).__name__, e)})
+
+
+def render_fabric(fabric):
+    # the configs plus the manifest generate_device_configs would record for
+    # them, so a client writing them locally keeps --incremental and the
+    # conflict checks working
+    engine = config_generator.get_render_engine()
+    configs = OrderedDict()
+    fabric_manifest = manifest.empty_manifest()
+    for template, vars in fabric.devices():
+        output_filename = vars['hostname'] + '.txt'
+        configs[output_filename] = engine.render(template, vars)
+        template_hash = engine.template_hash(template)
+        fabric_manifest['templates'][template] = template_hash
+        fabric_manifest['devices'][vars['hostname']] = {'template': template,
+                                                        'filename': output_filename,
+                                                        'hash': manifest.device_hash(vars, template_hash)}
+    fabric_manifest['fabric'] = conflicts.fabric_record(fabric.user_input)
+    return {'name_prefix': fabric.name_prefix, 'configs': configs, 'manifest': fabric_manifest}
+
+
+def render_plan(fabric_cache, specs, requested_format=None):
+    if not isinstance(specs, list):
+        specs = [specs]
+    fabrics = [fabric_cache.get(spec) for spec in specs]
+    records = (record for fabric in fabrics for record in plan_export.fabric_records(fabric))
+    return ''.join(plan_export.plan_lines(records, plan_export.plan_format('-', requested_format)))
+
+
+class UnixRequestHandler(RequestHandler):
+    # TCP_NODELAY does not apply to a Unix socket
+    disable_nagle_algorithm = False
+
+
+class TCPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def remove_socket(socket_path):
+    # unlink a socket left behind at socket_path; anything else at the path
+    # is not the service's to remove
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(errno.EEXIST, 'exists and is not a socket', socket_path)
+    os.remove(socket_path)
+
+
+def make_server(host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None,
+                cache_size=DEFAULT_FABRIC_CACHE_SIZE, quiet=False):
+    # a server bound to host:port, or to socket_path if given, with the
+    # templates already compiled; call serve_forever() on it
+    if socket_path:
+        remove_socket(socket_path)
+        server = UnixServer(socket_path, UnixRequestHandler)
+    else:
+        server = TCPServer((host, port), RequestHandler)
+    server.fabrics = FabricCache(cache_size)
+    server.quiet = quiet
+    config_generator.get_render_engine()
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class Client(object):
+    # Small client for a running service; one connection is kept open for
+    # all requests. Errors of the service are raised as KeyError (unknown
+    # device) or ValueError (invalid fabric), like the local functions do.
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None, timeout=60):
+        if socket_path:
+            self.connection = UnixHTTPConnection(socket_path, timeout=timeout)
+        else:
+            self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def request(self, method, path, body=None):
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        self.connection.request(method, path, data, headers)
+        response = self.connection.getresponse()
+        text = response.read().decode('utf-8')
+        if response.status == 404:
+            raise KeyError(json.loads(text)['error'])
+        if response.status != 200:
+            raise ValueError(json.loads(text)['error'])
+        return text
+
+    def health(self):
+        return json.loads(self.request('GET', '/health'))
+
+    def rendered_fabric(self, spec):
+        # {'name_prefix', 'configs', 'manifest'} as returned by POST /fabric
+        return json.loads(self.request('POST', '/fabric', spec), object_pairs_hook=OrderedDict)
+
+    def fabric(self, spec):
+        # {filename: config} of every device of the fabric, in output order
+        return self.rendered_fabric(spec)['configs']
+
+    def device(self, spec, hostname):
+        return self.request('POST', '/device/' + quote(hostname), spec)
+
+    def plan(self, specs, plan_format='jsonl'):
+        return self.request('POST', '/plan?format=' + quote(plan_format), specs)
+
+    def close(self):
+        self.connection.close()
+
+
+def write_fabrics(client, specs, output_root):
+    # The client side of --spec generation: render through the service and
+    # write the configs and the manifest locally, after the same validation
+    # and conflict checks as a local run; returns batch-style results.
+    user_inputs, failures = batch.validate_fabric_specs(specs)
+    user_inputs, conflict_failures = batch.check_conflicts(user_inputs, output_root)
+    results = failures + conflict_failures
+    for user_input in user_inputs:
+        name_prefix = user_input['name_prefix']
+        try:
+            rendered = client.rendered_fabric(conflicts.fabric_record(user_input))
+        except ValueError as e:
+            results.append({'name_prefix': name_prefix, 'ok': False, 'devices': 0, 'error': str(e)})
+            continue
+        fabric_dir = config_generator.create_fabric_directory(name_prefix, output_root)
+        for filename, config in rendered['configs'].items():
+            write_atomic(os.path.join(fabric_dir, filename), [config])
+        # configs of removed devices are left in place, as by a plain local run
+        manifest.keep_removed_devices(manifest.load_manifest(fabric_dir), rendered['manifest'])
+        manifest.save_manifest(fabric_dir, rendered['manifest'])
+        results.append({'name_prefix': name_prefix, 'ok': True, 'devices': len(rendered['configs']),
+                        'error': None})
+    return results
+
+
+def parse_args(argv):
+    connection = argparse.ArgumentParser(add_help=False)
+    connection.add_argument('--host', default=DEFAULT_HOST, help='address to listen on / connect to (default: %(default)s)')
+    connection.add_argument('--port', type=int, default=DEFAULT_PORT, help='TCP port (default: %(default)s)')
+    connection.add_argument('--socket', metavar='PATH', help='use a Unix socket instead of TCP')
+    parser = argparse.ArgumentParser(description='Render service for NX-OS VXLAN EVPN fabric configurations.')
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    commands.required = True
+    serve = commands.add_parser('serve', parents=[connection], help='run the service')
+    serve.add_argument('--cache-size', type=int, default=DEFAULT_FABRIC_CACHE_SIZE, metavar='N',
+                       help='number of fabric plans to keep (default: %(default)s)')
+    serve.add_argument('--quiet', action='store_true', help='do not log requests')
+    fabric = commands.add_parser('fabric', parents=[connection],
+                                 help='render every fabric of a spec file and write the configs')
+    fabric.add_argument('--spec', required=True, metavar='FILE')
+    fabric.add_argument('--output', default=config_generator.config_output, metavar='DIR',
+                        help='root output directory (default: %(default)s)')
+    device = commands.add_parser('device', parents=[connection], help='print the config of one device')
+    device.add_argument('hostname')
+    device.add_argument('--spec', required=True, metavar='FILE')
+    plan = commands.add_parser('plan', parents=[connection], help='print the address plan of a spec file')
+    plan.add_argument('--spec', required=True, metavar='FILE')
+    plan.add_argument('--plan-format', choices=plan_export.PLAN_FORMATS, default='jsonl')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.command == 'serve':
+        try:
+            server = make_server(args.host, args.port, args.socket, args.cache_size, args.quiet)
+        except OSError as e:
+            print("Unable to serve on {0}: {1}".format(args.socket or '{0}:{1}'.format(args.host, args.port), e))
+            return 2
+        print("Serving on {0}".format(args.socket or '{0}:{1}'.format(args.host, args.port)))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if args.socket:
+                remove_socket(args.socket)
+        return 0
+
+    try:
+        specs = batch.load_fabric_specs(args.spec)
+    except (OSError, ValueError) as e:
+        print("Unable to read spec file {0}: {1}".format(args.spec, e))
+        return 2
+    client = Client(args.host, args.port, args.socket)
+    try:
+        if args.command == 'fabric':
+            results = write_fabrics(client, specs, args.output)
+            print(batch.format_summary(results))
+            if all(result['ok'] for result in results):
+                return 0
+            return 1
+        if args.command == 'device':
+            matches = [spec for spec in specs if isinstance(spec, dict) and spec.get('name_prefix') and
+                       args.hostname.startswith(str(spec.get('name_prefix', '')))]
+            if not matches:
+                print("No fabric in {0} matches {1}".format(args.spec, args.hostname))
+                return 1
+            print(client.device(matches[0], args.hostname), end='')
+            return 0
+        print(client.plan(specs, args.plan_format), end='')
+        return 0
+    except KeyError as e:
+        print(e.args[0])
+        return 1
+    except (OSError, ValueError) as e:
+        print(e)
+        return 1
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
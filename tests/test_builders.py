@@ -0,0 +1,321 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config_generator
+
+# The build_*_vars functions compute the address plan with integer offsets
+# (allocator.build_address_plan) behind Fabric. The reference_*_vars
+# functions below are the builders they replaced, which index the
+# ipaddress networks directly; both must produce the same variables.
+
+
+def reference_spine_vars(user_input, leaf_vars, bleaf_vars):
+    spine_mgmt_ipaddresses = []
+    spine_hostnames = []
+    spine_loopback0_ipaddresses = []
+    leaf_bgp_peers = []
+    spine_interfaces = []
+
+    layout = config_generator.fabric_layout(user_input)
+    mgmt_network = user_input['mgmt_subnet']
+    loopback_network = user_input['loopback_subnet']
+    ptp_network = user_input['ptp_subnet']
+    ptp_block = layout['ptp_block']
+
+    mgmt_default_gateway = str(mgmt_network[1])
+    pim_anycast_rp = str(loopback_network.broadcast_address)
+
+    leaf_numbers = range(1, layout['num_leafs'] + 1)
+    for bleaf in bleaf_vars:
+        leaf_bgp_peers.append({'ip': bleaf['loopback0_ip'], 'description': bleaf['hostname']})
+
+    for leaf in leaf_vars:
+        leaf_bgp_peers.append({'ip': leaf['loopback0_ip'], 'description': leaf['hostname']})
+
+    for spine in range(0, layout['num_spines']):
+        this_spine_interfaces = []
+        spine_hostnames.append(config_generator.spine_hostname(user_input['name_prefix'], spine + 1))
+        spine_mgmt_ipaddresses.append(str(mgmt_network[spine + layout['spine_mgmt_start'] + 1]))
+        spine_loopback0_ipaddresses.append(str(loopback_network[spine + layout['spine_lo0_start'] + 1]))
+
+        for leaf_number in leaf_numbers:
+            int_portnum = 'Ethernet1/{0}'.format(leaf_number)
+            int_description = "I,{0}_{1},{2}/31,POINT-TO-POINT,area {3}".format(
+                leaf_vars[leaf_number - 1]['hostname'],
+                'Ethernet1/' + str(config_generator.START_IF_NUM + spine),
+                leaf_vars[leaf_number - 1]['interfaces'][spine]['ipaddress'],
+                user_input['ospf_area'])
+            int_ipaddress = str(ptp_network[((leaf_number - 1) * 2) + (ptp_block * spine)])
+
+            this_spine_interfaces.append({'portnum': int_portnum,
+                                        'ipaddress': int_ipaddress,
+                                        'description': int_description})
+        for bleaf in range(0, layout['num_bleafs']):
+            this_bleaf_name = config_generator.bleaf_hostname(user_input['name_prefix'], bleaf + 1)
+            bleaf_port = layout['bleaf_port_start'] + bleaf + 1
+            int_portnum = 'Ethernet1/{0}'.format(bleaf_port)
+            int_ipaddress = str(ptp_network[((bleaf_port - 1) * 2) + (ptp_block * spine)])
+            int_description = "I,{0}_{1},{2}/31,POINT-TO-POINT,area {3}".format(
+                              this_bleaf_name,
+                              'Ethernet1/' + str(config_generator.START_IF_NUM + spine),
+                              str(ptp_network[((bleaf_port - 1) * 2) + 1 + (ptp_block * spine)]),
+                              user_input['ospf_area'])
+
+            this_spine_interfaces.append({'portnum': int_portnum,
+                                        'ipaddress': int_ipaddress,
+                                        'description': int_description})
+        spine_interfaces.append(this_spine_interfaces)
+
+    spine_vars = {'spines': []}
+    for i in range(0, layout['num_spines']):
+        spine_vars['spines'].append({'hostname': spine_hostnames[i],
+                                     'loopback0_ip': spine_loopback0_ipaddresses[i],
+                                     'pim_anycast_rp': pim_anycast_rp,
+                                     'pim_rps': spine_loopback0_ipaddresses,
+                                     'interfaces': spine_interfaces[i],
+                                     'bgp_asn': user_input['bgp_asn'],
+                                     'ospf_area': user_input['ospf_area'],
+                                     'multicast_group_range': (user_input['multicast_group_range'] + '/24'),
+                                     'leaf_bgp_peers': leaf_bgp_peers,
+                                     'mgmt_ipaddress': spine_mgmt_ipaddresses[i],
+                                     'mgmt_default_gateway': mgmt_default_gateway,
+                                     'mgmt_ipmask': str(mgmt_network.prefixlen),
+                                     })
+
+    return spine_vars
+
+
+def reference_bleaf_vars(user_input, leaf_vars):
+    bleaf_mgmt_ipaddresses = []
+    bleaf_hostnames = []
+    bleaf_loopback0_ipaddresses = []
+    bleaf_loopback1_ipaddresses = []
+    spine_bgp_peers = leaf_vars[0]['spine_bgp_peers']
+    bleaf_interfaces = []
+
+    layout = config_generator.fabric_layout(user_input)
+    mgmt_network = user_input['mgmt_subnet']
+    loopback_network = user_input['loopback_subnet']
+    ptp_network = user_input['ptp_subnet']
+    ptp_block = layout['ptp_block']
+
+    mgmt_default_gateway = str(mgmt_network[1])
+    pim_anycast_rp = leaf_vars[0]['pim_anycast_rp']
+    vxlan_vni_prefix = leaf_vars[0]['vxlan_vni_prefix']
+
+    for bleaf in range(0, layout['num_bleafs']):
+        bleaf_port = layout['bleaf_port_start'] + bleaf + 1
+        bleaf_mgmt_ipaddresses.append(str(mgmt_network[(bleaf + 1) + layout['bleaf_mgmt_start']]))
+        bleaf_hostnames.append(config_generator.bleaf_hostname(user_input['name_prefix'], bleaf + 1))
+        bleaf_loopback0_ipaddresses.append(str(loopback_network[layout['bleaf_lo0_start'] + bleaf + 1]))
+        bleaf_loopback1_ipaddresses.append(str(loopback_network[layout['bleaf_lo1_start'] + bleaf + 1]))
+        this_bleaf_interfaces = []
+        for spine in range(0, layout['num_spines']):
+            this_spine_name = config_generator.spine_hostname(user_input['name_prefix'], spine + 1)
+            int_portnum = 'Ethernet1/{0}'.format(config_generator.START_IF_NUM + spine)
+            int_ipaddress = str(ptp_network[((bleaf_port - 1) * 2) + 1 + (ptp_block * spine)])
+            int_description = "I,{0}_{1},{2}/31,POINT-TO-POINT,area {3}".format(
+                              this_spine_name,
+                              "Ethernet1/" + str(bleaf_port),
+                              str(ptp_network[((bleaf_port - 1) * 2) + (ptp_block * spine)]),
+                              user_input['ospf_area'])
+
+            this_bleaf_interfaces.append({'portnum': int_portnum,
+                                        'ipaddress': int_ipaddress,
+                                        'description': int_description})
+        bleaf_interfaces.append(this_bleaf_interfaces)
+    bleaf_vars = {'bleafs': []}
+    for i in range(0, layout['num_bleafs']):
+        bleaf_vars['bleafs'].append({'hostname': bleaf_hostnames[i],
+                                     'loopback0_ip': bleaf_loopback0_ipaddresses[i],
+                                     'loopback1_ip': bleaf_loopback1_ipaddresses[i],
+                                     'mgmt_ipaddress': bleaf_mgmt_ipaddresses[i],
+                                     'mgmt_default_gateway': mgmt_default_gateway,
+                                     'mgmt_ipmask': str(mgmt_network.prefixlen),
+                                     'multicast_group_range': (user_input['multicast_group_range'] + '/24'),
+                                     'ospf_area': user_input['ospf_area'],
+                                     'bgp_asn': user_input['bgp_asn'],
+                                     'vxlan_vni_prefix': vxlan_vni_prefix,
+                                     'vxlan_vrf': user_input['vxlan_vrf'],
+                                     'pim_anycast_rp': pim_anycast_rp,
+                                     'interfaces': bleaf_interfaces[i],
+                                     'spine_bgp_peers': spine_bgp_peers})
+
+    return bleaf_vars
+
+
+def reference_leaf_vars(user_input):
+    vpc_domains = []
+    is_first_leaf = []
+    leaf_mgmt_ipaddresses = []
+    leaf_hostnames = []
+    leaf_loopback0_ipaddresses = []
+    leaf_loopback1_ipaddresses = []
+    leaf_loopback1_vtep_ipaddresses = []
+    peer_leafs = []
+    peer_leaf_mgmt_ipaddresses = []
+    leaf_vlan2_ipaddresses = []
+    leaf_vlan2_descriptions = []
+    spine_bgp_peers = []
+    leaf_interfaces = []
+
+    layout = config_generator.fabric_layout(user_input)
+    mgmt_network = user_input['mgmt_subnet']
+    loopback_network = user_input['loopback_subnet']
+    ptp_network = user_input['ptp_subnet']
+    ptp_block = layout['ptp_block']
+    leaf_mgmt_start = layout['leaf_mgmt_start']
+    vlan2_start = layout['vlan2_start']
+    mgmt_default_gateway = str(mgmt_network[1])
+    vxlan_vni_prefix = str(user_input['bgp_asn'])[2:]
+    pim_anycast_rp = str(user_input['loopback_subnet'].broadcast_address)
+
+    leaf_numbers = range(1, layout['num_leafs'] + 1)
+    pair_numbers = range(1, layout['num_leaf_pairs'] + 1)
+    for leaf_number in leaf_numbers:
+        this_leaf_interfaces = []
+        this_spine_bgp_peers = []
+        for spine in range(0, layout['num_spines']):
+            this_spine_name = config_generator.spine_hostname(user_input['name_prefix'], spine + 1)
+            int_portnum = "Ethernet1/{0}".format(config_generator.START_IF_NUM + spine)
+            int_ipaddress = str(ptp_network[(((leaf_number - 1) * 2) + 1) + (ptp_block * spine)])
+            int_description = "I,{0}_{1},{2}/31,POINT-TO-POINT,area {3}".format(
+                              this_spine_name,
+                              "Ethernet1/" + str(leaf_number),
+                              str(ptp_network[((leaf_number - 1) * 2) + (ptp_block * spine)]),
+                              user_input['ospf_area'])
+
+            this_leaf_interfaces.append({'portnum': int_portnum,
+                                         'ipaddress': int_ipaddress,
+                                         'description': int_description})
+            this_spine_bgp_peers.append({'description': this_spine_name,
+                                         'ip': '{}'.format(str(loopback_network[layout['spine_lo0_start'] + spine + 1]))})
+        leaf_interfaces.append(this_leaf_interfaces)
+        spine_bgp_peers.append(this_spine_bgp_peers)
+        leaf_mgmt_ipaddresses.append(str(mgmt_network[leaf_number + leaf_mgmt_start]))
+        leaf_loopback0_ipaddresses.append(str(loopback_network[leaf_number]))
+        leaf_loopback1_ipaddresses.append(str(loopback_network[layout['lo1_start'] + leaf_number]))
+        leaf_vlan2_ipaddresses.append(str(loopback_network[vlan2_start + leaf_number]))
+        leaf_hostnames.append(config_generator.leaf_hostname(user_input['name_prefix'], leaf_number))
+        # leafs are vPC pairs: odd leaf numbers peer with the next leaf, even with the previous
+        if (leaf_number % 2) > 0:
+            peer_number = leaf_number + 1
+            is_first_leaf.append(True)
+        else:
+            peer_number = leaf_number - 1
+            is_first_leaf.append(False)
+        this_leaf_peer = config_generator.leaf_hostname(user_input['name_prefix'], peer_number)
+        peer_leafs.append(this_leaf_peer)
+        peer_leaf_mgmt_ipaddresses.append(str(mgmt_network[peer_number + leaf_mgmt_start]))
+        leaf_vlan2_descriptions.append("I,{0}_Vlan2,{1}/31,POINT-TO-POINT,area {2}".format(
+                                       this_leaf_peer,
+                                       str(loopback_network[vlan2_start + peer_number]),
+                                       user_input['ospf_area']))
+
+    for pair_number in pair_numbers:
+        vpc_domains.extend([str(config_generator.START_VPC + pair_number), str(config_generator.START_VPC + pair_number)])
+        leaf_loopback1_vtep_ipaddresses.extend([str(loopback_network[layout['vtep_start'] + pair_number]), str(loopback_network[layout['vtep_start'] + pair_number])])
+
+    leaf_vars = {'leafs': []}
+    for i in range(0, layout['num_leafs']):
+        leaf_vars['leafs'].append({'hostname': leaf_hostnames[i],
+                                   'first_leaf': is_first_leaf[i],
+                                   'loopback0_ip': leaf_loopback0_ipaddresses[i],
+                                   'loopback1_ip': leaf_loopback1_ipaddresses[i],
+                                   'loopback1_vtepip': leaf_loopback1_vtep_ipaddresses[i],
+                                   'vpc_domain': vpc_domains[i],
+                                   'mgmt_ipaddress': leaf_mgmt_ipaddresses[i],
+                                   'mgmt_default_gateway': mgmt_default_gateway,
+                                   'mgmt_ipmask': str(mgmt_network.prefixlen),
+                                   'peer_leaf_mgmt_ip': peer_leaf_mgmt_ipaddresses[i],
+                                   'peer_leaf': peer_leafs[i],
+                                   'multicast_group_range': (user_input['multicast_group_range'] + '/24'),
+                                   'ospf_area': user_input['ospf_area'],
+                                   'bgp_asn': user_input['bgp_asn'],
+                                   'vxlan_vni_prefix': vxlan_vni_prefix,
+                                   'vxlan_vrf': user_input['vxlan_vrf'],
+                                   'pim_anycast_rp': pim_anycast_rp,
+                                   'vlan2_ip': leaf_vlan2_ipaddresses[i],
+                                   'vlan2_description': leaf_vlan2_descriptions[i],
+                                   'interfaces': leaf_interfaces[i],
+                                   'spine_bgp_peers': spine_bgp_peers[i]})
+
+    return leaf_vars
+
+
+def plain(value):
+    # the builders return model records; compare them as the dicts they replace
+    return json.loads(json.dumps(value, default=lambda record: record.as_dict()))
+
+
+def fabric(profile, num_leaf_pairs, num_bleafs, num_spines):
+    # a valid fabric of the given size, with blocks of the size it needs
+    layout = config_generator.fabric_layout({'profile': profile, 'num_leaf_pairs': num_leaf_pairs,
+                                             'num_bleafs': num_bleafs, 'num_spines': num_spines})
+    return config_generator.validate_user_input({
+        'profile': profile,
+        'num_leaf_pairs': num_leaf_pairs,
+        'num_bleafs': num_bleafs,
+        'num_spines': num_spines,
+        'mgmt_subnet': '10.0.0.0/{0}'.format(layout['mgmt_prefixlen']),
+        'loopback_subnet': '10.64.0.0/{0}'.format(layout['loopback_prefixlen']),
+        'ptp_subnet': '10.128.0.0/{0}'.format(layout['ptp_prefixlen']),
+        'name_prefix': 'DC1SFRM',
+        'bgp_asn': 65001,
+        'ospf_area': '0.0.0.1',
+        'multicast_group_range': '239.1.1.0',
+        'vxlan_vrf': 'prod'})
+
+
+class BuilderTest(unittest.TestCase):
+    def assert_same_vars(self, user_input):
+        leaf_vars = config_generator.build_leaf_vars(user_input)
+        bleaf_vars = config_generator.build_bleaf_vars(user_input, leaf_vars['leafs'])
+        spine_vars = config_generator.build_spine_vars(user_input, leaf_vars['leafs'], bleaf_vars['bleafs'])
+        reference_leafs = reference_leaf_vars(user_input)
+        reference_bleafs = reference_bleaf_vars(user_input, reference_leafs['leafs'])
+        reference_spines = reference_spine_vars(user_input, reference_leafs['leafs'], reference_bleafs['bleafs'])
+        for built, reference in ((leaf_vars, reference_leafs), (bleaf_vars, reference_bleafs),
+                                 (spine_vars, reference_spines)):
+            # the same bytes as hashed into the manifest
+            self.assertEqual(json.dumps(plain(built), sort_keys=True), json.dumps(reference, sort_keys=True))
+
+    def test_gen1(self):
+        self.assert_same_vars(fabric('gen1', 15, 2, 4))
+
+    def test_gen2(self):
+        self.assert_same_vars(fabric('gen2', 31, 2, 4))
+
+    def test_small(self):
+        self.assert_same_vars(fabric('gen1', 1, 1, 1))
+
+    def test_profile_offsets(self):
+        # a fabric smaller than the profile keeps the profile's fixed border
+        # leaf and spine loopbacks and border leaf ports
+        user_input = fabric('gen1', 14, 2, 4)
+        self.assert_same_vars(user_input)
+        leaf_vars = config_generator.build_leaf_vars(user_input)
+        bleaf_vars = config_generator.build_bleaf_vars(user_input, leaf_vars['leafs'])
+        spine_vars = config_generator.build_spine_vars(user_input, leaf_vars['leafs'], bleaf_vars['bleafs'])
+        self.assertEqual([bleaf['loopback0_ip'] for bleaf in bleaf_vars['bleafs']], ['10.64.0.31', '10.64.0.32'])
+        self.assertEqual([bleaf['loopback1_ip'] for bleaf in bleaf_vars['bleafs']], ['10.64.0.131', '10.64.0.132'])
+        self.assertEqual([spine['loopback0_ip'] for spine in spine_vars['spines']],
+                         ['10.64.0.33', '10.64.0.34', '10.64.0.35', '10.64.0.36'])
+        self.assertEqual([interface['portnum'] for interface in spine_vars['spines'][0]['interfaces'][-2:]],
+                         ['Ethernet1/31', 'Ethernet1/32'])
+
+    def test_scaled(self):
+        # too large for the profile's /24 layout: packed and grown blocks
+        self.assert_same_vars(fabric('gen1', 200, 16, 3))
+
+    def test_largest(self):
+        self.assert_same_vars(fabric('gen2', config_generator.MAX_LEAF_PAIRS,
+                                     config_generator.MAX_BLEAFS, config_generator.MAX_SPINES))
+
+
+if __name__ == '__main__':
+    unittest.main()
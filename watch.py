@@ -0,0 +1,154 @@
+import os
+import time
+
+import batch
+import config_generator
+import conflicts
+import manifest
+
+# --watch: poll the templates and the spec file and re-render only what an
+# edit affects. The compiled templates and every device's variables stay in
+# memory between polls; a template edit re-renders the devices that use that
+# template, a spec edit regenerates only the fabrics whose definition changed.
+DEFAULT_INTERVAL = 1.0
+
+
+def file_signature(path):
+    # changes whenever the file is rewritten; None for a missing file
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def fabric_key(user_input):
+    return repr(sorted(conflicts.fabric_record(user_input).items()))
+
+
+class Watcher(object):
+    def __init__(self, spec_path, output_root):
+        self.spec_path = spec_path
+        self.output_root = output_root
+        self.engine = config_generator.get_render_engine()
+        self.spec_signature = None
+        self.template_signatures = {}
+        # hash of the template source the current configs were rendered from
+        self.template_hashes = {}
+        for name in config_generator.TemplateFilenames:
+            self.template_signatures[name] = file_signature(os.path.join(config_generator.homedir, name))
+            self.template_hashes[name] = self.engine.template_hash(name)
+        # name prefix -> {'key', 'user_input', 'devices': [(template, vars)], 'manifest'}
+        self.fabrics = {}
+        # a fabric failed to generate; try again after the next template edit
+        self.retry_spec = False
+
+    def dependents(self, template):
+        # {name prefix: [vars]} of the devices rendered with template
+        devices = {}
+        for name_prefix, fabric in self.fabrics.items():
+            matches = [vars for device_template, vars in fabric['devices'] if device_template == template]
+            if matches:
+                devices[name_prefix] = matches
+        return devices
+
+    def load_fabric(self, user_input):
+        # regenerate a new or changed fabric; unchanged devices are kept as they are
+        report = config_generator.generate_device_configs(user_input, self.output_root, verbose=False,
+                                                          incremental=True)
+        fabric_dir = os.path.join(self.output_root, user_input['name_prefix'])
+        self.fabrics[user_input['name_prefix']] = {
+            'key': fabric_key(user_input),
+            'user_input': user_input,
+            'devices': list(config_generator.build_device_vars(user_input)),
+            'manifest': manifest.load_manifest(fabric_dir)}
+        return report
+
+    def poll_spec(self):
+        signature = file_signature(self.spec_path)
+        if signature == self.spec_signature:
+            return []
+        self.spec_signature = signature
+        try:
+            user_inputs, failures = batch.validate_fabric_specs(batch.load_fabric_specs(self.spec_path))
+        except (OSError, ValueError) as e:
+            return ["Unable to read spec file {0}: {1}".format(self.spec_path, e)]
+        user_inputs, conflict_failures = batch.check_conflicts(user_inputs, self.output_root)
+        lines = ["FAILED  {0}: {1}".format(failure['name_prefix'], failure['error'])
+                 for failure in failures + conflict_failures]
+        names = set()
+        for user_input in user_inputs:
+            names.add(user_input['name_prefix'])
+            previous = self.fabrics.get(user_input['name_prefix'])
+            if previous is not None and previous['key'] == fabric_key(user_input):
+                continue
+            try:
+                report = self.load_fabric(user_input)
+            except Exception as e:
+                lines.append("FAILED  {0}: {1}: {2}".format(user_input['name_prefix'], type(e).__name__, e))
+                self.retry_spec = True
+                continue
+            # just the counts; listing every device of a fabric is too noisy here
+            lines.append(manifest.format_report(user_input['name_prefix'], report).split('\n')[0])
+        for name_prefix in sorted(set(self.fabrics) - names):
+            # its configs stay on disk; it is just no longer watched
+            del self.fabrics[name_prefix]
+            lines.append("{0}: no longer in {1}".format(name_prefix, self.spec_path))
+        return lines
+
+    def poll_template(self, template):
+        signature = file_signature(os.path.join(config_generator.homedir, template))
+        if signature == self.template_signatures[template]:
+            return []
+        self.template_signatures[template] = signature
+        try:
+            self.engine.reload(template)
+        except Exception as e:
+            # keep watching; the devices are re-rendered once the template is fixed
+            return ["{0}: {1}: {2}".format(template, type(e).__name__, e)]
+        template_hash = self.engine.template_hash(template)
+        if template_hash == self.template_hashes[template]:
+            return []
+        self.template_hashes[template] = template_hash
+        start = time.perf_counter()
+        devices = self.dependents(template)
+        for name_prefix, fabric_devices in devices.items():
+            fabric = self.fabrics[name_prefix]
+            fabric_dir = os.path.join(self.output_root, name_prefix)
+            fabric['manifest']['templates'][template] = template_hash
+            for vars in fabric_devices:
+                output_filename = vars['hostname'] + ".txt"
+                config_generator.write_template_to_file(vars, template, output_filename, fabric_dir)
+                fabric['manifest']['devices'][vars['hostname']] = {
+                    'template': template,
+                    'filename': output_filename,
+                    'hash': manifest.device_hash(vars, template_hash)}
+            manifest.save_manifest(fabric_dir, fabric['manifest'])
+        return ["{0}: re-rendered {1} devices in {2} fabrics ({3:.2f}s)".format(
+                template, sum(len(fabric_devices) for fabric_devices in devices.values()), len(devices),
+                time.perf_counter() - start)]
+
+    def poll(self):
+        # one cycle; returns the lines to report, empty if nothing changed.
+        # Templates go first so a spec change is rendered with current templates.
+        lines = []
+        for template in config_generator.TemplateFilenames:
+            lines += self.poll_template(template)
+        if lines and self.retry_spec:
+            self.retry_spec = False
+            self.spec_signature = None
+        return lines + self.poll_spec()
+
+
+def watch(spec_path, output_root, interval=DEFAULT_INTERVAL):
+    watcher = Watcher(spec_path, output_root)
+    print("Watching {0} and the templates in {1} (Ctrl-C to stop)".format(spec_path, config_generator.homedir))
+    try:
+        while True:
+            lines = watcher.poll()
+            if lines:
+                print('\n'.join(lines))
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    return 0